@@ -1,15 +1,16 @@
-from pathlib import Path
-from queue import SimpleQueue
-from string import Template
-from typing import Optional
 from threading import Lock
+from typing import Optional
 import os
 import datetime
 import time
 import logging
 
-from library.ai_requests import run_ai_request_stream
 from library.get_dictionary_defs import correct_vocab_readings, parse_vocab_readings
+from library.response_cache import run_cached_ai_request_stream
+from library.prompt_templates import get_prompt_template, read_cached_file
+from library.context_packer import build_prompt_with_history
+from library.ai_requests import CancellationToken
+from library.request_metrics import mark_loop_break, set_prompt_template
 from library.settings_manager import settings
 
 
@@ -25,47 +26,69 @@ class ANSIColors:
 
 
 class UIUpdateCommand:
-    def __init__(self, update_type: str, sentence: str, token: str):
+    def __init__(self, update_type: str, sentence: str, token: str, index: int = 0):
         self.update_type = update_type
         self.sentence = sentence
         self.token = token
-
-
-REQUEST_INTERRUPT_FLAG = False
-REQUEST_INTERRUPT_LOCK = Lock()
-
-
-def request_interrupt_atomic_swap(new_value: bool) -> bool:
-    global REQUEST_INTERRUPT_FLAG
-    with REQUEST_INTERRUPT_LOCK:
-        old_value = REQUEST_INTERRUPT_FLAG
-        REQUEST_INTERRUPT_FLAG = new_value
-    return old_value
+        # requests that run concurrently (e.g. 'Best of Three') each stream into their own section
+        self.index = index
+
+
+class UIUpdateQueue:
+    """
+    Passes UIUpdateCommands from the processing threads to the UI. Consecutive tokens for the same sentence, update
+    type and index are coalesced into a single command, so the UI can apply everything that arrived in one go.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._pending = []  # type: list[tuple[UIUpdateCommand, list[str]]]
+
+    def put(self, command: UIUpdateCommand):
+        with self._lock:
+            if self._pending:
+                last_command, tokens = self._pending[-1]
+                if (last_command.sentence == command.sentence and last_command.update_type == command.update_type
+                        and last_command.index == command.index):
+                    tokens.append(command.token)
+                    return
+            self._pending.append((command, [command.token]))
+
+    def drain(self) -> list[UIUpdateCommand]:
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for command, tokens in pending:
+            command.token = "".join(tokens)
+        return [command for command, _ in pending]
+
+    def empty(self) -> bool:
+        with self._lock:
+            return not self._pending
 
 
 def run_vocabulary_list(sentence: str, temp: Optional[float] = None,
-                        update_queue: Optional[SimpleQueue[UIUpdateCommand]] = None,
-                        api_override: Optional[str] = None):
+                        update_queue: Optional[UIUpdateQueue] = None,
+                        api_override: Optional[str] = None, cancel_token: Optional[CancellationToken] = None,
+                        refresh: bool = False):
     if temp is None:
         temp = settings.get_setting('define.temperature')
-    request_interrupt_atomic_swap(False)
 
     prompt_file = settings.get_setting('define.define_prompt_filepath')
     try:
-        template = read_file_or_throw(prompt_file)
+        template = get_prompt_template(prompt_file)
+        set_prompt_template(prompt_file)
         template_data = {
             'sentence': sentence
         }
-        prompt = Template(template).safe_substitute(template_data)
+        prompt = template.render({}, template_data)
     except FileNotFoundError as e:
         logging.error(f"Error loading prompt template: {e}")
         return None
 
     last_tokens = []
-    for tok in run_ai_request_stream(prompt, ["</task>"], print_prompt=False,
-                                     temperature=temp, ban_eos_token=False, max_response=500,
-                                     api_override=api_override):
-        if request_interrupt_atomic_swap(False):
+    for tok in run_cached_ai_request_stream(prompt, ["</task>"], print_prompt=False,
+                                            temperature=temp, ban_eos_token=False, max_response=500,
+                                            api_override=api_override, cancel_token=cancel_token, refresh=refresh):
+        if cancel_token is not None and cancel_token.is_cancelled:
             print(ANSIColors.GREEN, end="")
             print("-interrupted-\n")
             print(ANSIColors.END, end="")
@@ -76,6 +99,7 @@ def run_vocabulary_list(sentence: str, temp: Optional[float] = None,
         last_tokens = last_tokens[-10:]
         if len(last_tokens) == 10 and len(set(last_tokens)) <= 3:
             logging.warning(f"AI generated exited because of looping response: {last_tokens}")
+            mark_loop_break()
             break
 
 
@@ -94,74 +118,96 @@ def should_generate_vocabulary_list(sentence):
     return False
 
 
+def format_previous_lines(history: list[str]) -> str:
+    if not history:
+        return ""
+    return "Previous lines:\n" + "\n".join(f"- {line}" for line in history)
+
+
+def format_question_history(history: list[str]) -> str:
+    previous_lines_list = [""]
+    if len(history):
+        previous_lines_list.append("The previous lines in the story are:")
+        previous_lines_list.extend(history)
+    return "\n".join(previous_lines_list)
+
+
 def translate_with_context(history, sentence, temp=None, style="",
-                           update_queue: Optional[SimpleQueue[UIUpdateCommand]] = None, index: int = 0,
-                           api_override: Optional[str] = None):
+                           update_queue: Optional[UIUpdateQueue] = None, index: int = 0,
+                           api_override: Optional[str] = None,
+                           cancel_token: Optional[CancellationToken] = None, refresh: bool = False) -> Optional[str]:
     if temp is None:
         temp = settings.get_setting('translate.temperature')
 
-    request_interrupt_atomic_swap(False)
+    max_response = 100
     prompt_file = settings.get_setting('translate.translate_prompt_filepath')
     try:
-        template = read_file_or_throw(prompt_file)
-        previous_lines = ""
-        if history:
-            previous_lines = "Previous lines:\n" + "\n".join(f"- {line}" for line in history)
-        template_data = {
+        template = get_prompt_template(prompt_file)
+        set_prompt_template(prompt_file)
+        static_data = {
             'context': settings.get_setting('general.translation_context'),
-            'previous_lines': previous_lines,
+        }
+        template_data = {
             'sentence': sentence,
             'style': style,
         }
-        prompt = Template(template).safe_substitute(template_data)
+        prompt, prompt_token_count = build_prompt_with_history(template, static_data, template_data, history,
+                                                               format_previous_lines, max_response, api_override)
     except FileNotFoundError as e:
         logging.error(f"Error loading prompt template: {e}")
         return None
 
+    result = ""
+
     last_tokens = []
     if update_queue is not None:
         if index == 0:
-            update_queue.put(UIUpdateCommand("translate", sentence, "- "))
+            update_queue.put(UIUpdateCommand("translate", sentence, "- ", index))
         else:
-            update_queue.put(UIUpdateCommand("translate", sentence, f"#{index}. "))
-    for tok in run_ai_request_stream(prompt,
-                                     ["</english>", "</task>"],
-                                     print_prompt=False, temperature=temp, ban_eos_token=False, max_response=100,
-                                     api_override=api_override):
-        if request_interrupt_atomic_swap(False):
+            update_queue.put(UIUpdateCommand("translate", sentence, f"#{index}. ", index))
+    for tok in run_cached_ai_request_stream(prompt,
+                                            ["</english>", "</task>"],
+                                            print_prompt=False, temperature=temp, ban_eos_token=False,
+                                            max_response=max_response, api_override=api_override,
+                                            cancel_token=cancel_token, prompt_token_count=prompt_token_count,
+                                            refresh=refresh):
+        if cancel_token is not None and cancel_token.is_cancelled:
             print(ANSIColors.GREEN, end="")
             print("-interrupted-\n")
             print(ANSIColors.END, end="")
             break
         if update_queue is not None:
-            update_queue.put(UIUpdateCommand("translate", sentence, tok))
+            update_queue.put(UIUpdateCommand("translate", sentence, tok, index))
+        result += tok
         # explicit exit for models getting stuck on a token (e.g. "............")
         last_tokens.append(tok)
         last_tokens = last_tokens[-10:]
         if len(last_tokens) == 10 and len(set(last_tokens)) <= 3:
             logging.warning(f"AI generated exited because of looping response: {last_tokens}")
+            mark_loop_break()
             break
+    return result
 
 
 def translate_with_context_cot(history, sentence, temp=None,
-                               update_queue: Optional[SimpleQueue[UIUpdateCommand]] = None,
+                               update_queue: Optional[UIUpdateQueue] = None,
                                api_override: Optional[str] = None, use_examples: bool = True,
                                update_token_key: Optional[str] = 'translate',
-                               suggested_readings: Optional[str] = None):
+                               suggested_readings: Optional[str] = None,
+                               cancel_token: Optional[CancellationToken] = None,
+                               refresh: bool = False) -> Optional[str]:
     if temp is None:
         temp = settings.get_setting('translate_cot.temperature')
 
-    request_interrupt_atomic_swap(False)
     prompt_file = settings.get_setting('translate_cot.cot_prompt_filepath')
     examples_file = settings.get_setting('translate_cot.cot_examples_filepath')
 
+    max_response = 1000
     readings_string = ""
     try:
-        template = read_file_or_throw(prompt_file)
-        examples = read_file_or_throw(examples_file) if use_examples else ""
-        previous_lines = ""
-        if history:
-            previous_lines = "Previous lines:\n" + "\n".join(f"- {line}" for line in history)
+        template = get_prompt_template(prompt_file)
+        set_prompt_template(prompt_file)
+        examples = read_cached_file(examples_file) if use_examples else ""
         context = settings.get_setting('general.translation_context')
         if suggested_readings:
             if settings.get_setting('define_into_analysis.enable_jmdict_replacements'):
@@ -177,13 +223,15 @@ def translate_with_context_cot(history, sentence, temp=None,
                     logging.warning(f"No vocabulary parsed from suggested_readings: {suggested_readings}")
             else:
                 readings_string = "\nSuggested Readings:" + suggested_readings
-        template_data = {
+        static_data = {
             'examples': examples,
             'context': context + readings_string,
-            'previous_lines': previous_lines,
+        }
+        template_data = {
             'sentence': sentence
         }
-        prompt = Template(template).safe_substitute(template_data)
+        prompt, prompt_token_count = build_prompt_with_history(template, static_data, template_data, history,
+                                                               format_previous_lines, max_response, api_override)
     except FileNotFoundError as e:
         logging.error(f"Error loading prompt template: {e}")
         return None
@@ -191,11 +239,13 @@ def translate_with_context_cot(history, sentence, temp=None,
     result = ""
 
     last_tokens = []
-    for tok in run_ai_request_stream(prompt,
-                                     ["</task>"],
-                                     print_prompt=False, temperature=temp, ban_eos_token=False, max_response=1000,
-                                     api_override=api_override):
-        if request_interrupt_atomic_swap(False):
+    for tok in run_cached_ai_request_stream(prompt,
+                                            ["</task>"],
+                                            print_prompt=False, temperature=temp, ban_eos_token=False,
+                                            max_response=max_response, api_override=api_override,
+                                            cancel_token=cancel_token, prompt_token_count=prompt_token_count,
+                                            refresh=refresh):
+        if cancel_token is not None and cancel_token.is_cancelled:
             print(ANSIColors.GREEN, end="")
             print("-interrupted-\n")
             print(ANSIColors.END, end="")
@@ -208,6 +258,7 @@ def translate_with_context_cot(history, sentence, temp=None,
         last_tokens = last_tokens[-10:]
         if len(last_tokens) == 10 and len(set(last_tokens)) <= 3:
             logging.warning(f"AI generated exited because of looping response: {last_tokens}")
+            mark_loop_break()
             break
 
     if len(sentence) > 30 and settings.get_setting_fallback('translate_cot.save_cot_outputs', fallback=False):
@@ -220,46 +271,45 @@ def translate_with_context_cot(history, sentence, temp=None,
         os.makedirs(folder_name, exist_ok=True)
         with open(os.path.join(folder_name, filename), "w", encoding='utf-8') as f:
             f.write(input_and_output)
+    return result
 
 
 def ask_question(question: str, sentence: str, history: list[str], temp: Optional[float] = None,
-                 update_queue: Optional[SimpleQueue[UIUpdateCommand]] = None, update_token_key: str = "qanda",
-                 api_override: Optional[str] = None):
+                 update_queue: Optional[UIUpdateQueue] = None, update_token_key: str = "qanda",
+                 api_override: Optional[str] = None, cancel_token: Optional[CancellationToken] = None,
+                 refresh: bool = False):
     if temp is None:
         temp = settings.get_setting('q_and_a.temperature')
 
-    request_interrupt_atomic_swap(False)
-
-    previous_lines_list = [""]
-    if len(history):
-        previous_lines_list.append("The previous lines in the story are:")
-        previous_lines_list.extend(history)
-    previous_lines = "\n".join(previous_lines_list)
-
     print(ANSIColors.GREEN, end="")
     print("___Adding context to question\n")
-    print(previous_lines)
+    print(format_question_history(history))
     print("___\n")
     print(ANSIColors.END, end="")
 
+    max_response = 1000
     prompt_file = settings.get_setting('q_and_a.q_and_a_prompt_filepath')
     try:
-        template = read_file_or_throw(prompt_file)
-        template_data = {
+        template = get_prompt_template(prompt_file)
+        set_prompt_template(prompt_file)
+        static_data = {
             'context': settings.get_setting('general.translation_context'),
-            'previous_lines': previous_lines,
+        }
+        template_data = {
             'question': question,
         }
-        prompt = Template(template).safe_substitute(template_data)
+        prompt, prompt_token_count = build_prompt_with_history(template, static_data, template_data, history,
+                                                               format_question_history, max_response, api_override)
     except FileNotFoundError as e:
         logging.error(f"Error loading prompt template: {e}")
         return None
 
     last_tokens = []
-    for tok in run_ai_request_stream(prompt, ["</answer>", "</task>"], print_prompt=False,
-                                     temperature=temp, ban_eos_token=False, max_response=1000,
-                                     api_override=api_override):
-        if request_interrupt_atomic_swap(False):
+    for tok in run_cached_ai_request_stream(prompt, ["</answer>", "</task>"], print_prompt=False,
+                                            temperature=temp, ban_eos_token=False, max_response=max_response,
+                                            api_override=api_override, cancel_token=cancel_token,
+                                            prompt_token_count=prompt_token_count, refresh=refresh):
+        if cancel_token is not None and cancel_token.is_cancelled:
             print(ANSIColors.GREEN, end="")
             print("-interrupted-\n")
             print(ANSIColors.END, end="")
@@ -271,12 +321,6 @@ def ask_question(question: str, sentence: str, history: list[str], temp: Optiona
         last_tokens = last_tokens[-10:]
         if len(last_tokens) == 10 and len(set(last_tokens)) <= 3:
             logging.warning(f"AI generated exited because of looping response: {last_tokens}")
+            mark_loop_break()
             break
 
-
-def read_file_or_throw(filepath: str) -> str:
-    file_to_load = Path(filepath)
-    if not file_to_load.exists():
-        raise FileNotFoundError(f"File not found: {filepath}")
-    with open(file_to_load, 'r', encoding='utf-8') as f:
-        return f.read()
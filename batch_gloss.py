@@ -0,0 +1,120 @@
+"""
+Looks up the vocabulary of every line of a script with the offline dictionary ('Define (without AI)'), e.g. to make a
+study list before reading a novel. No AI is involved, and the lines are split across a process per core.
+
+    python -m batch_gloss [script.txt|script.jsonl] --processes 8
+
+Writes two files next to the script:
+- [script].gloss.jsonl: {"index", "sentence", "vocabulary": [{"word", "reading", "meaning"}]} per line.
+- [script].vocabulary.tsv: every word in the script once, most frequent first, with its count, reading and meaning.
+"""
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator
+import argparse
+import json
+import logging
+import os
+import time
+
+from library.dictionary_index import DEFAULT_INDEX_PATH, get_dictionary_index, set_dictionary_index
+from library.get_dictionary_defs import get_definitions_for_sentences, get_tagger
+from library.script_files import read_script
+
+# lines per task; big enough that each task is one dictionary query and little pickling overhead
+DEFAULT_CHUNK_SIZE = 500
+
+# (word, reading, meaning)
+GlossEntry = tuple[str, str, str]
+
+
+def _initialize_worker(index_path: str):
+    # once per process, rather than per line
+    set_dictionary_index(index_path)
+    get_tagger()
+
+
+def gloss_lines(lines: list[str]) -> list[list[GlossEntry]]:
+    """The words of each line that have a meaning, without repeats within a line."""
+    glossed = []
+    for definitions in get_definitions_for_sentences(lines):
+        entries = {}
+        for definition in definitions:
+            if definition.meanings and definition.base_form not in entries:
+                entries[definition.base_form] = (definition.base_form, ",".join(definition.readings),
+                                                 definition.meanings[0])
+        glossed.append(list(entries.values()))
+    return glossed
+
+
+def gloss_script(lines: list[str], processes: int, chunk_size: int,
+                 index_path: str) -> Iterator[tuple[int, list[GlossEntry]]]:
+    """Yields (index, entries) for each line, in order."""
+    chunks = [lines[start:start + chunk_size] for start in range(0, len(lines), chunk_size)]
+    with ProcessPoolExecutor(max_workers=processes, initializer=_initialize_worker,
+                             initargs=(index_path,)) as executor:
+        index = 0
+        for glossed_chunk in executor.map(gloss_lines, chunks):
+            for entries in glossed_chunk:
+                yield index, entries
+                index += 1
+
+
+def write_vocabulary(vocabulary_path: str, counts: Counter, entries_by_word: dict[str, GlossEntry]):
+    with open(vocabulary_path, "w", encoding="utf-8") as f:
+        f.write("word\treading\tcount\tmeaning\n")
+        # most_common keeps the order of first appearance for equal counts
+        for word, count in counts.most_common():
+            _, reading, meaning = entries_by_word[word]
+            f.write(f"{word}\t{reading}\t{count}\t{meaning}\n")
+
+
+def run(script_path: str, output_path: str, vocabulary_path: str, processes: int, chunk_size: int,
+        index_path: str):
+    lines = read_script(script_path)
+    logging.info(f"Glossing {len(lines)} lines with {processes} processes")
+    counts = Counter()
+    entries_by_word = {}
+    start_time = time.time()
+    with open(output_path, "w", encoding="utf-8") as output:
+        for index, entries in gloss_script(lines, processes, chunk_size, index_path):
+            record = {
+                "index": index,
+                "sentence": lines[index],
+                "vocabulary": [{"word": word, "reading": reading, "meaning": meaning}
+                               for word, reading, meaning in entries],
+            }
+            output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            for entry in entries:
+                counts[entry[0]] += 1
+                entries_by_word.setdefault(entry[0], entry)
+            if (index + 1) % chunk_size == 0:
+                logging.info(f"[{index + 1}/{len(lines)}] {(index + 1) / (time.time() - start_time):.0f} lines/s")
+    write_vocabulary(vocabulary_path, counts, entries_by_word)
+    logging.info(f"Glossed {len(lines)} lines in {time.time() - start_time:.1f}s, {len(counts)} distinct words. "
+                 f"Wrote {output_path} and {vocabulary_path}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Look up the vocabulary of every line of a script with the offline "
+                                                 "dictionary.")
+    parser.add_argument("script", help="A text file with one line per sentence, or a JSONL file with a 'text' "
+                                       "field per line.", type=str)
+    parser.add_argument("--output", help="The per line JSONL file. Defaults to [script].gloss.jsonl", type=str)
+    parser.add_argument("--vocabulary", help="The vocabulary list for the whole script. Defaults to "
+                                             "[script].vocabulary.tsv", type=str)
+    parser.add_argument("--processes", help="How many processes to split the lines across. Defaults to the "
+                                            "number of cores.", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk-size", help="How many lines each process looks up at a time.", type=int,
+                        default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--index", help="The dictionary index to use.", type=str, default=DEFAULT_INDEX_PATH)
+    args = parser.parse_args()
+
+    if args.index == DEFAULT_INDEX_PATH:
+        # builds it from jitendex.json if needed, once, before the workers start
+        get_dictionary_index()
+    script_base_path = os.path.splitext(args.script)[0]
+    run(args.script, args.output or f"{script_base_path}.gloss.jsonl",
+        args.vocabulary or f"{script_base_path}.vocabulary.tsv", max(1, args.processes), max(1, args.chunk_size),
+        args.index)
@@ -0,0 +1,136 @@
+"""
+Translates every line of a script without the UI, e.g. to pre-translate a chapter overnight.
+
+    python -m batch_translate [story_name] [script.txt|script.jsonl] --output translations.jsonl
+
+Each finished line is appended to the output as {"index", "sentence", "translation"}. The output doubles as the
+checkpoint: running the same command again skips the lines that are already in it.
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock
+from typing import Optional
+import argparse
+import json
+import logging
+import os
+import time
+
+from ai_prompts import translate_with_context, translate_with_context_cot
+from library.ai_requests import AI_SERVICE_GEMINI, AI_SERVICE_OOBABOOGA, AI_SERVICE_OPENAI, CancellationToken
+from library.context_packer import get_history_start
+from library.response_cache import set_namespace
+from library.script_files import read_script
+from library.settings_manager import settings
+
+
+def read_checkpoint(output_path: str, lines: list[str]) -> set[int]:
+    """The indices of the lines that were already translated into the output."""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f):
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # most likely a partial line from a crash; that sentence will be translated again
+                logging.warning(f"Skipping unreadable line {line_number + 1} of {output_path}")
+                continue
+            index = record.get("index")
+            if isinstance(index, int) and index < len(lines) and lines[index] == record.get("sentence"):
+                done.add(index)
+    return done
+
+
+class BatchTranslator:
+    def __init__(self, lines: list[str], output_path: str, concurrency: int, use_cot: bool,
+                 api_override: Optional[str] = None):
+        self.lines = lines
+        self.output_path = output_path
+        self.concurrency = concurrency
+        self.use_cot = use_cot
+        self.api_override = api_override
+        self.history_length = settings.get_setting('general.translation_history_length')
+        self.cancel_token = CancellationToken()
+        self._output_lock = Lock()
+
+    def translate_line(self, index: int) -> Optional[str]:
+        history = self.lines[get_history_start(index, self.history_length):index]
+        if self.use_cot:
+            return translate_with_context_cot(history, self.lines[index], api_override=self.api_override,
+                                              cancel_token=self.cancel_token)
+        return translate_with_context(history, self.lines[index], api_override=self.api_override,
+                                      cancel_token=self.cancel_token)
+
+    def write_result(self, output, index: int, translation: str):
+        record = {"index": index, "sentence": self.lines[index], "translation": translation.strip()}
+        with self._output_lock:
+            output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            output.flush()
+
+    def run(self) -> bool:
+        """Returns whether every line was translated."""
+        done = read_checkpoint(self.output_path, self.lines)
+        todo = [i for i in range(len(self.lines)) if i not in done]
+        logging.info(f"{len(done)} of {len(self.lines)} lines were already translated, {len(todo)} to go.")
+        if not todo:
+            return True
+
+        failures = 0
+        start_time = time.time()
+        with open(self.output_path, "a", encoding="utf-8") as output, \
+                ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {executor.submit(self.translate_line, i): i for i in todo}
+            try:
+                for completed, future in enumerate(as_completed(futures), start=1):
+                    index = futures[future]
+                    try:
+                        translation = future.result()
+                    except Exception as e:
+                        translation = None
+                        logging.error(f"Exception while translating line {index}: {e}")
+                    if translation and not self.cancel_token.is_cancelled:
+                        self.write_result(output, index, translation)
+                    else:
+                        failures += 1
+                    elapsed = time.time() - start_time
+                    logging.info(f"[{completed}/{len(todo)}] line {index} done, "
+                                 f"{completed / elapsed:.2f} lines/s")
+            except KeyboardInterrupt:
+                logging.info("Interrupted; rerun the same command to continue where this left off.")
+                self.cancel_token.cancel()
+                executor.shutdown(wait=True, cancel_futures=True)
+                return False
+        if failures:
+            logging.warning(f"{failures} lines failed; rerun the same command to retry them.")
+        return failures == 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Translate every line of a script, with the previous lines as "
+                                                 "context.")
+    parser.add_argument("source",
+                        help="The story name; settings/[source].toml is loaded if it exists, like in the UI.",
+                        type=str)
+    parser.add_argument("script", help="A text file with one line per sentence, or a JSONL file with a 'text' "
+                                       "field per line.", type=str)
+    parser.add_argument("--output", help="The JSONL file to write to (and resume from). Defaults to "
+                                         "[script].translations.jsonl", type=str)
+    parser.add_argument("--concurrency", help="How many lines are translated at the same time. The service's "
+                                              "max_concurrent_requests still applies.", type=int, default=4)
+    parser.add_argument("--cot", help="Use the chain-of-thought translation prompt.", action="store_true")
+    parser.add_argument("--api", help="The AI service to use instead of ai_settings.api.",
+                        choices=[AI_SERVICE_OOBABOOGA, AI_SERVICE_OPENAI, AI_SERVICE_GEMINI])
+    args = parser.parse_args()
+
+    source_settings_path = os.path.join("settings", f"{args.source}.toml")
+    if os.path.isfile(source_settings_path):
+        settings.override_settings(source_settings_path)
+    set_namespace(args.source)
+
+    output_path = args.output or f"{os.path.splitext(args.script)[0]}.translations.jsonl"
+    translator = BatchTranslator(read_script(args.script), output_path, max(1, args.concurrency), args.cot,
+                                 args.api)
+    if not translator.run():
+        raise SystemExit(1)
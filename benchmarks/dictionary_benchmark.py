@@ -0,0 +1,133 @@
+"""
+Benchmark of the offline define path ('Define (without AI)'): parsing with fugashi, looking words up in the dictionary
+index and formatting the definitions.
+
+    python -m benchmarks.dictionary_benchmark --repeat 50 --target 5000
+
+The corpus is repeated, so apart from each_uncached, repeated lines come from the parse cache like they would in the
+app. It reports lines per second and the memory allocated per line. --profile also prints the functions where the time goes
+and the lines that allocate the most. Run it from the repository root, like the app, so data/jitendex.db is found.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+import argparse
+import cProfile
+import io
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+
+from library import dictionary_index
+from library.get_dictionary_defs import get_definitions_for_sentences, get_definitions_string, parse_morphemes
+
+DEFAULT_CORPUS_PATH = os.path.join("benchmarks", "data", "dictionary_corpus.txt")
+THREAD_COUNT = 4
+
+
+def read_corpus(path: str) -> list[str]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def define_each(lines: list[str]):
+    """What the UI does: one sentence at a time."""
+    for line in lines:
+        get_definitions_string(line)
+
+
+def define_each_uncached(lines: list[str]):
+    """Every sentence parsed by MeCab, as if it had never been seen."""
+    for line in lines:
+        parse_morphemes.cache_clear()
+        get_definitions_string(line)
+
+
+def define_batched(lines: list[str]):
+    get_definitions_for_sentences(lines)
+
+
+def define_threaded(lines: list[str]):
+    chunk_size = max(1, len(lines) // (THREAD_COUNT * 4))
+    with ThreadPoolExecutor(max_workers=THREAD_COUNT) as executor:
+        list(executor.map(get_definitions_for_sentences,
+                          (lines[start:start + chunk_size] for start in range(0, len(lines), chunk_size))))
+
+
+MODES = {
+    "each": define_each,
+    "each_uncached": define_each_uncached,
+    "batched": define_batched,
+    "threaded": define_threaded,
+}
+
+
+def measure_throughput(define: Callable[[list[str]], None], lines: list[str]) -> float:
+    start = time.perf_counter()
+    define(lines)
+    return len(lines) / (time.perf_counter() - start)
+
+
+def measure_allocations(define: Callable[[list[str]], None], lines: list[str]) -> tuple[float, int, list]:
+    """Peak KiB, the number of allocated blocks still held at the end, and the lines holding the most."""
+    tracemalloc.start()
+    define(lines)
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    stats = snapshot.statistics("lineno")
+    return peak_bytes / 1024, sum(stat.count for stat in stats), stats[:10]
+
+
+def profile(define: Callable[[list[str]], None], lines: list[str]) -> str:
+    parse_morphemes.cache_clear()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    define(lines)
+    profiler.disable()
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats("tottime").print_stats(15)
+    return output.getvalue()
+
+
+def run_benchmark(mode: str, lines: list[str], show_profile: bool) -> Optional[float]:
+    define = MODES[mode]
+    # warm up (fugashi, the index connection), then start without any parses cached
+    define(lines[:10])
+    parse_morphemes.cache_clear()
+
+    lines_per_second = measure_throughput(define, lines)
+    parse_morphemes.cache_clear()
+    peak_kib, allocation_count, top_allocations = measure_allocations(define, lines)
+    print(f"{mode:<14} {len(lines)} lines  {lines_per_second:.0f} lines/s  "
+          f"peak {peak_kib:.1f} KiB ({peak_kib / len(lines):.2f} KiB/line)  {allocation_count} blocks held")
+    if show_profile:
+        print(profile(define, lines))
+        print("Top allocations still held:")
+        for stat in top_allocations:
+            print(f"  {stat}")
+        print()
+    return lines_per_second
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the offline define path.")
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS_PATH, help="Sentences to define, one per line.")
+    parser.add_argument("--repeat", type=int, default=25, help="How many times to go through the corpus.")
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES))
+    parser.add_argument("--index", default=None, help=f"Dictionary index to use, {dictionary_index.DEFAULT_INDEX_PATH} "
+                                                      f"by default.")
+    parser.add_argument("--profile", action="store_true", help="Print the top functions and allocations.")
+    parser.add_argument("--target", type=float, default=0,
+                        help="Lines/s the 'each' mode should reach; exits with an error if it doesn't.")
+    args = parser.parse_args()
+
+    if args.index:
+        dictionary_index.set_dictionary_index(args.index)
+    corpus = read_corpus(args.corpus) * args.repeat
+    results = {mode: run_benchmark(mode, corpus, args.profile) for mode in args.modes}
+    if args.target and results.get("each", 0) < args.target:
+        print(f"Below the target of {args.target:.0f} lines/s")
+        sys.exit(1)
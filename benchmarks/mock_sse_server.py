@@ -0,0 +1,79 @@
+"""
+A fake completions server that streams tokens like Oobabooga or an OpenAI-compatible server, at a set rate.
+
+    python -m benchmarks.mock_sse_server --port 5500 --token-rate 50 --latency 0.2
+
+Requests to paths starting with /ooba get an Oobabooga-style stream; any other path gets an OpenAI-style stream,
+which ends with 'data: [DONE]'.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import itertools
+import json
+import time
+
+# varied enough that the looping-response checks in ai_prompts never trigger
+WORDS = ["The", " quick", " brown", " fox", " jumps", " over", " the", " lazy", " dog", ".", " It", " was",
+         " a", " bright", " cold", " day", " in", " April", ",", " and", " the", " clocks", " were", " striking",
+         " thirteen", "."]
+
+
+class MockCompletionsHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # otherwise each small event waits on the client's delayed ACK (~40ms on a reused connection)
+    disable_nagle_algorithm = True
+    # set by serve()
+    token_rate = 0.0
+    latency = 0.0
+    response_tokens = 100
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        token_count = min(self.response_tokens, request.get("max_tokens") or self.response_tokens)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        time.sleep(self.latency)
+        start = time.perf_counter()
+        for i, word in zip(range(token_count), itertools.cycle(WORDS)):
+            if self.token_rate > 0:
+                # paced against the start, so that slow writes don't lower the rate
+                delay = start + i / self.token_rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            self._write_event(json.dumps({"choices": [{"text": word}]}))
+        if not self.path.startswith("/ooba"):
+            self._write_event("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _write_event(self, data: str):
+        event = f"data: {data}\n\n".encode("utf-8")
+        self.wfile.write(f"{len(event):x}\r\n".encode("ascii") + event + b"\r\n")
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port: int, token_rate: float, latency: float, response_tokens: int):
+    MockCompletionsHandler.token_rate = token_rate
+    MockCompletionsHandler.latency = latency
+    MockCompletionsHandler.response_tokens = response_tokens
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockCompletionsHandler)
+    server.daemon_threads = True
+    print(f"Mock server listening on 127.0.0.1:{port}", flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="A fake SSE completions server for benchmarks.")
+    parser.add_argument("--port", type=int, default=5500)
+    parser.add_argument("--token-rate", type=float, default=0, help="Tokens per second per request; 0 is unlimited.")
+    parser.add_argument("--latency", type=float, default=0, help="Seconds before the first token.")
+    parser.add_argument("--tokens", type=int, default=100, help="Tokens per response (capped by max_tokens).")
+    args = parser.parse_args()
+    serve(args.port, args.token_rate, args.latency, args.tokens)
@@ -0,0 +1,225 @@
+"""
+End-to-end benchmark of the streaming path (prompt building -> AI request -> UIUpdateQueue), against the mock server
+in benchmarks/mock_sse_server.py, so it needs no GPU or network.
+
+    python -m benchmarks.streaming_benchmark --api OpenAI --token-rate 200 --iterations 20
+
+For each prompt type it reports the token throughput, the time to first token (to the UI queue), the CPU time per
+token and the peak Python memory per request. Run it from the repository root, like the app.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Thread
+from typing import Callable, Optional
+import argparse
+import contextlib
+import io
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from ai_prompts import (UIUpdateQueue, UIUpdateCommand, ask_question, run_vocabulary_list, translate_with_context,
+                        translate_with_context_cot)
+from library.ai_requests import AI_SERVICE_OOBABOOGA, AI_SERVICE_OPENAI, STREAMING_CORE_ASYNC, STREAMING_CORE_THREADS
+from library.settings_manager import settings
+
+SENTENCE = "今日は本当にいい天気ですね。"
+HISTORY = ["昨日は雨が降っていた。", "傘を忘れてしまった。", "だから、びしょ濡れになった。"]
+# how often the UI drains its update queue (see jp_vocab_monitor_ui.UPDATE_LOOP_LATENCY_MS)
+UI_DRAIN_INTERVAL_SECONDS = 0.05
+
+
+class TimedUIUpdateQueue(UIUpdateQueue):
+    """Notes when the first token of a request reached the UI queue."""
+    def __init__(self, leading_updates: int):
+        super().__init__()
+        # updates put before the response starts (e.g. the '- ' in front of a translation) aren't tokens
+        self.leading_updates = leading_updates
+        self.first_token_time = None  # type: Optional[float]
+        self.token_count = 0
+
+    def put(self, command: UIUpdateCommand):
+        if self.leading_updates > 0:
+            self.leading_updates -= 1
+        else:
+            if self.first_token_time is None:
+                self.first_token_time = time.perf_counter()
+            self.token_count += 1
+        super().put(command)
+
+
+def translate(update_queue: UIUpdateQueue):
+    translate_with_context(HISTORY, SENTENCE, update_queue=update_queue)
+
+
+def translate_cot(update_queue: UIUpdateQueue):
+    translate_with_context_cot(HISTORY, SENTENCE, update_queue=update_queue)
+
+
+def define(update_queue: UIUpdateQueue):
+    run_vocabulary_list(SENTENCE, update_queue=update_queue)
+
+
+def q_and_a(update_queue: UIUpdateQueue):
+    ask_question("What does 本当に mean here?", SENTENCE, HISTORY, update_queue=update_queue)
+
+
+# name -> (scenario, the number of UI updates it puts before the response)
+SCENARIOS = {
+    "translate": (translate, 1),
+    "translate_cot": (translate_cot, 0),
+    "define": (define, 0),
+    "q_and_a": (q_and_a, 0),
+}
+
+
+class RequestResult:
+    def __init__(self, start: float, first_token: Optional[float], end: float, token_count: int,
+                 ui_update_count: int):
+        self.start = start
+        self.first_token = first_token
+        self.end = end
+        self.token_count = token_count
+        self.ui_update_count = ui_update_count
+
+
+def run_request(scenario: Callable[[UIUpdateQueue], None], leading_updates: int) -> RequestResult:
+    update_queue = TimedUIUpdateQueue(leading_updates)
+    ui_update_count = 0
+    done = Event()
+
+    def drain_like_the_ui():
+        nonlocal ui_update_count
+        while not done.wait(UI_DRAIN_INTERVAL_SECONDS):
+            ui_update_count += len(update_queue.drain())
+
+    drain_thread = Thread(target=drain_like_the_ui)
+    drain_thread.start()
+    start = time.perf_counter()
+    scenario(update_queue)
+    end = time.perf_counter()
+    done.set()
+    drain_thread.join()
+    ui_update_count += len(update_queue.drain())
+    return RequestResult(start, update_queue.first_token_time, end, update_queue.token_count, ui_update_count)
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def run_scenario(name: str, iterations: int, concurrency: int) -> dict:
+    scenario, leading_updates = SCENARIOS[name]
+    # warm up (prompt templates, tokenizer, connections)
+    run_request(scenario, leading_updates)
+
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda _: run_request(scenario, leading_updates), range(iterations)))
+    wall_seconds = time.perf_counter() - wall_start
+    cpu_seconds = time.process_time() - cpu_start
+
+    tracemalloc.start()
+    run_request(scenario, leading_updates)
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    tokens = sum(r.token_count for r in results)
+    ttfts = [r.first_token - r.start for r in results if r.first_token is not None]
+    return {
+        "scenario": name,
+        "requests": len(results),
+        "tokens": tokens,
+        "tokens_per_second": tokens / wall_seconds if wall_seconds else 0,
+        "ttft_p50_ms": percentile(ttfts, 0.5) * 1000 if ttfts else None,
+        "ttft_p95_ms": percentile(ttfts, 0.95) * 1000 if ttfts else None,
+        "cpu_us_per_token": cpu_seconds / tokens * 1e6 if tokens else None,
+        "ui_updates_per_request": sum(r.ui_update_count for r in results) / len(results),
+        "peak_kib_per_request": peak_bytes / 1024,
+    }
+
+
+def format_results(results: list[dict]) -> str:
+    def number(value: Optional[float], digits: int = 1) -> str:
+        return "-" if value is None else f"{value:.{digits}f}"
+
+    header = (f"{'scenario':<14}{'requests':>9}{'tokens':>8}{'tok/s':>9}{'TTFT p50':>10}{'TTFT p95':>10}"
+              f"{'CPU us/tok':>11}{'UI upd/req':>11}{'peak KiB':>10}")
+    lines = [header, "-" * len(header)]
+    for r in results:
+        lines.append(f"{r['scenario']:<14}{r['requests']:>9}{r['tokens']:>8}{number(r['tokens_per_second']):>9}"
+                     f"{number(r['ttft_p50_ms']):>10}{number(r['ttft_p95_ms']):>10}"
+                     f"{number(r['cpu_us_per_token']):>11}{number(r['ui_updates_per_request']):>11}"
+                     f"{number(r['peak_kib_per_request']):>10}")
+    return "\n".join(lines)
+
+
+def get_free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_mock_server(port: int, token_rate: float, latency: float, tokens: int) -> subprocess.Popen:
+    # a separate process, so that the server's CPU time isn't counted
+    server = subprocess.Popen([sys.executable, "-m", "benchmarks.mock_sse_server", "--port", str(port),
+                               "--token-rate", str(token_rate), "--latency", str(latency), "--tokens", str(tokens)],
+                              stdout=subprocess.PIPE, text=True)
+    server.stdout.readline()
+    return server
+
+
+def get_benchmark_settings(api: str, port: int, streaming_core: str, concurrency: int) -> dict:
+    return {
+        "ai_settings": {
+            "api": api,
+            "streaming_core": streaming_core,
+        },
+        "oobabooga_api": {
+            "request_url": f"http://127.0.0.1:{port}/ooba/v1/completions",
+            "max_concurrent_requests": concurrency,
+        },
+        "openai_api": {
+            "request_url": f"http://127.0.0.1:{port}/openai/v1/completions",
+            "model": "mock",
+            "max_concurrent_requests": concurrency,
+        },
+        # every request should reach the server, and nothing should be written to disk
+        "response_cache": {"enabled": False},
+        "response_recording": {"enabled": False},
+        "request_metrics": {"enabled": False},
+        "translate_cot": {"save_cot_outputs": False},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the streaming path against a mock server.")
+    parser.add_argument("--api", choices=[AI_SERVICE_OPENAI, AI_SERVICE_OOBABOOGA], default=AI_SERVICE_OPENAI)
+    parser.add_argument("--streaming-core", choices=[STREAMING_CORE_THREADS, STREAMING_CORE_ASYNC],
+                        default=STREAMING_CORE_THREADS)
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--iterations", type=int, default=10, help="Requests per scenario.")
+    parser.add_argument("--concurrency", type=int, default=1, help="Requests in flight at once.")
+    parser.add_argument("--token-rate", type=float, default=0, help="Tokens per second per request; 0 is unlimited.")
+    parser.add_argument("--latency", type=float, default=0, help="Seconds the server waits before the first token.")
+    parser.add_argument("--tokens", type=int, default=200, help="Tokens per response (capped by max_response).")
+    args = parser.parse_args()
+
+    port = get_free_port()
+    mock_server = start_mock_server(port, args.token_rate, args.latency, args.tokens)
+    try:
+        settings.override_settings_from_dict(get_benchmark_settings(args.api, port, args.streaming_core,
+                                                                    args.concurrency))
+        all_results = []
+        for scenario_name in args.scenarios:
+            # the prompt functions print progress for the console; that's not what's being measured
+            with contextlib.redirect_stdout(io.StringIO()):
+                all_results.append(run_scenario(scenario_name, args.iterations, args.concurrency))
+        print(f"{args.api}, {args.streaming_core} core, {args.concurrency} concurrent, "
+              f"{args.token_rate or 'unlimited'} tok/s, {args.latency}s latency")
+        print(format_results(all_results))
+    finally:
+        mock_server.terminate()
@@ -1,13 +1,12 @@
+from concurrent.futures import ThreadPoolExecutor, wait
 from enum import Enum
 from queue import SimpleQueue, Empty
 from tkinter.scrolledtext import ScrolledText
 from typing import Optional
 import argparse
-import azure.cognitiveservices.speech as speechsdk
 import json
 import os
 import os.path
-import pyperclip
 import re
 import threading
 import time
@@ -15,12 +14,20 @@ import tkinter as tk
 import logging
 
 
-from ai_prompts import (should_generate_vocabulary_list, UIUpdateCommand, run_vocabulary_list,
-                        translate_with_context, translate_with_context_cot,
-                        request_interrupt_atomic_swap, ANSIColors, ask_question)
+from ai_prompts import (should_generate_vocabulary_list, UIUpdateCommand, UIUpdateQueue, run_vocabulary_list,
+                        translate_with_context, translate_with_context_cot, ask_question)
 from library.get_dictionary_defs import get_definitions_string
 from library.settings_manager import settings
-from library.ai_requests import AI_SERVICE_GEMINI, AI_SERVICE_OOBABOOGA, AI_SERVICE_OPENAI
+from library.response_cache import set_namespace
+from library.context_packer import trim_history
+from library.history_states import HistoryState, HistoryStates
+from library.script_prefetch import ScriptPrefetcher
+from library.request_metrics import command_context, get_latest_summary
+from library.reading_index import get_reading_index_status, start_reading_index_build
+from library.warm_up import start_warm_up
+from library.startup_profile import profile_startup
+from library.clipboard_sources import create_clipboard_source, CLIPBOARD_SOURCE_AUTO
+from library.ai_requests import AI_SERVICE_GEMINI, AI_SERVICE_OOBABOOGA, AI_SERVICE_OPENAI, CancellationToken
 
 
 CLIPBOARD_CHECK_LATENCY_MS = 250
@@ -56,7 +63,9 @@ class InvalidTranslationTypeException(Exception):
 class MonitorCommand:
     def __init__(self, command_type: str, sentence: str, history: list[str], prompt: str = None,
                  temp: Optional[float] = None, style: str = None, index: int = 0, api_override: Optional[str] = None,
-                 update_token_key: Optional[str] = None, include_readings: bool = False):
+                 update_token_key: Optional[str] = None, include_readings: bool = False,
+                 subcommands: Optional[list['MonitorCommand']] = None,
+                 cancel_token: Optional[CancellationToken] = None, refresh: bool = False):
         self.command_type = command_type
         self.sentence = sentence
         self.history = history
@@ -67,22 +76,31 @@ class MonitorCommand:
         self.api_override = api_override
         self.update_token_key = update_token_key
         self.include_readings = include_readings
+        # for 'parallel' commands, the independent commands to run at the same time
+        self.subcommands = subcommands
+        self.cancel_token = cancel_token
+        # skip the response cache and store the new response instead, e.g. for Retry
+        self.refresh = refresh
+        self.enqueue_time = None  # type: Optional[float]
 
+    def set_cancel_token(self, cancel_token: CancellationToken):
+        self.cancel_token = cancel_token
+        for subcommand in self.subcommands or []:
+            subcommand.set_cancel_token(cancel_token)
 
-class HistoryState:
-    def __init__(self, sentence, translation, translation_validation, definitions, question, response,
-                 history):
-        self.ui_sentence = sentence
-        self.ui_translation = translation
-        self.ui_translation_validation = translation_validation
-        self.ui_definitions = definitions
-        self.ui_question = question
-        self.ui_response = response
-        self.history = history
+    def set_refresh(self, refresh: bool):
+        self.refresh = refresh
+        for subcommand in self.subcommands or []:
+            subcommand.set_refresh(refresh)
+
+    def mark_enqueued(self):
+        self.enqueue_time = time.time()
+        for subcommand in self.subcommands or []:
+            subcommand.enqueue_time = self.enqueue_time
 
 
 class JpVocabUI:
-    def __init__(self, source: str):
+    def __init__(self, source: str, script_path: Optional[str] = None):
         self.tk_root = None
         self.text_output_scrolled_text = None
         self.get_definitions_button = None
@@ -95,10 +113,13 @@ class JpVocabUI:
         self.source = source  # the name of the config
 
         self.command_queue = SimpleQueue()
-        self.ui_update_queue = SimpleQueue()
+        # cancelled (and replaced) whenever the in-flight and queued AI requests should stop
+        self.cancel_token = CancellationToken()
+        self.ui_update_queue = UIUpdateQueue()
         self.last_command = None
 
-        self.last_clipboard_ts = 0
+        # filled from the clipboard source's thread
+        self.clipboard_queue = SimpleQueue()  # type: SimpleQueue[str]
 
         # ui data state
         self.ui_sentence = ""
@@ -107,9 +128,13 @@ class JpVocabUI:
         self.ui_definitions = ""
         self.ui_question = ""
         self.ui_response = ""
+        # ui_translation is built from these sections, so that concurrent translations don't interleave
+        self.ui_translation_sections = {}  # type: dict[int, str]
 
         # transient ui state
         self.last_textfield_value = ""
+        # the text currently shown in each tagged region of the text field, in display order
+        self.rendered_regions = {}  # type: dict[str, str]
         self.show_qanda = False
 
         # state for tkinter
@@ -117,6 +142,8 @@ class JpVocabUI:
         self.translation_style = None  # type: Optional[tk.StringVar]
         self.font_size = None  # type: Optional[tk.StringVar]
         self.font_size_changed_signal = None
+        self.metrics_summary = None  # type: Optional[tk.StringVar]
+        self.reading_index_status = None  # type: Optional[tk.StringVar]
 
         # monitor data
         self.history = []
@@ -133,14 +160,32 @@ class JpVocabUI:
             with open(cache_file, 'r', encoding='utf-8') as f:
                 self.history = json.load(f)
         self.history_length = settings.get_setting('general.translation_history_length')
-        self.history_states = []  # type: list[HistoryState]
+        self.history_states = HistoryStates(
+            max_in_memory=settings.get_setting_fallback('history_states.max_in_memory', 100),
+            spill_to_disk=settings.get_setting_fallback('history_states.spill_to_disk', True))
         self.history_states_index = -1
 
+        # script mode
+        self.script_prefetcher = None  # type: Optional[ScriptPrefetcher]
+        self.prefetch_api = settings.get_setting('ai_settings.api')
+        if script_path:
+            self.script_prefetcher = ScriptPrefetcher(
+                script_path,
+                self.prefetch_translation,
+                prefetch_lines=settings.get_setting_fallback('script_mode.prefetch_lines', 3),
+                history_length=self.history_length)
+
     def on_ai_service_change(self, *_args):
         selected_service = self.ai_service.get()
+        self.prefetch_api = selected_service
         print(f"AI service changed to: {selected_service}")
         logging.info(f"AI service changed to: {selected_service}")
 
+    def prefetch_translation(self, history: list[str], sentence: str,
+                             cancel_token: CancellationToken) -> Optional[str]:
+        # runs on the prefetch thread, so it mustn't touch any tkinter state
+        return translate_with_context(history, sentence, api_override=self.prefetch_api, cancel_token=cancel_token)
+
     def start_ui(self):
         root = tk.Tk()
         self.tk_root = root
@@ -305,6 +350,16 @@ class JpVocabUI:
         )
         font_spinbox.pack(side=tk.LEFT, padx=2)
 
+        # timing of the most recent AI request
+        self.metrics_summary = tk.StringVar(value="")
+        metrics_label = tk.Label(second_menu_bar, textvariable=self.metrics_summary, fg="gray")
+        self.create_tooltip(metrics_label, "Last AI request: time to first token, speed and queue wait")
+        metrics_label.pack(side=tk.RIGHT, padx=2)
+
+        # progress of the JMDict extraction for Define->Analysis
+        self.reading_index_status = tk.StringVar(value="")
+        tk.Label(second_menu_bar, textvariable=self.reading_index_status, fg="gray").pack(side=tk.RIGHT, padx=2)
+
         self.text_output_scrolled_text = ScrolledText(root, wrap="word")
         self.text_output_scrolled_text.grid(row=2, column=0, columnspan=6, sticky="nsew")
 
@@ -354,24 +409,32 @@ class JpVocabUI:
         self.load_history_state_at_index(self.history_states_index)
         # ui will be updated on the next update_ui tick
 
+    def get_current_history_state(self) -> HistoryState:
+        return HistoryState(self.ui_sentence, self.ui_translation, self.ui_translation_validation,
+                            self.ui_definitions, self.ui_question, self.ui_response,
+                            self.history_states.intern_history(self.history))
+
     def save_history_state(self):
-        self.history_states[self.history_states_index] = (
-            HistoryState(self.ui_sentence, self.ui_translation, self.ui_translation_validation,
-                         self.ui_definitions, self.ui_question, self.ui_response, self.history[:]))
+        self.history_states[self.history_states_index] = self.get_current_history_state()
 
     def load_history_state_at_index(self, index):
         history_state = self.history_states[index]  # type: HistoryState
         self.ui_sentence = history_state.ui_sentence
-        self.ui_translation = history_state.ui_translation
+        self.set_translation(history_state.ui_translation)
         self.ui_translation_validation = history_state.ui_translation_validation
         self.ui_definitions = history_state.ui_definitions
         self.ui_question = history_state.ui_question
         self.ui_response = history_state.ui_response
-        self.history = history_state.history
+        self.history = self.history_states.get_history(history_state.history_ids)
+        self.last_textfield_value = None
 
         with self.sentence_lock:
             self.locked_sentence = self.ui_sentence
 
+    def set_translation(self, translation: str):
+        self.ui_translation = translation
+        self.ui_translation_sections = {0: translation} if translation else {}
+
     def trigger_auto_behavior(self):
         style_enum = TranslationType(self.translation_style.get())
         self.perform_translation_string(style_enum)
@@ -385,7 +448,7 @@ class JpVocabUI:
             raise InvalidTranslationTypeException()
 
     def perform_translation(self, style: TranslationType):
-        request_interrupt_atomic_swap(True)
+        self.stop()
         self.show_qanda = False
 
         if style == TranslationType.Off:
@@ -394,51 +457,57 @@ class JpVocabUI:
             self.ui_definitions = ""
         elif style in [TranslationType.Translate, TranslationType.BestOfThree, TranslationType.ChainOfThought,
                        TranslationType.DefineAndChainOfThought, TranslationType.TranslateAndChainOfThought]:
-            self.ui_translation = ""
+            self.set_translation("")
             self.ui_translation_validation = ""
         else:
             raise ValueError(f"Unhandled 'TranslationType': {style}")
 
         if style == TranslationType.Translate:
-            self.command_queue.put(MonitorCommand(
+            self.queue_command(MonitorCommand(
                 "translate",
                 self.ui_sentence,
                 self.history[:],
                 index=1,
                 api_override=self.ai_service.get()))
         elif style == TranslationType.BestOfThree:
-            self.command_queue.put(MonitorCommand(
-                "translate",
-                self.ui_sentence,
-                self.history[:],
-                temp=settings.get_setting_fallback('translate_best_of_three.first_temperature', .7),
-                index=1,
-                api_override=self.ai_service.get()))
-            self.command_queue.put(MonitorCommand(
-                "translate",
-                self.ui_sentence,
-                self.history[:],
-                temp=settings.get_setting_fallback('translate_best_of_three.second_temperature', .7),
-                style="Aim for a literal translation.",
-                index=2,
-                api_override=self.ai_service.get()))
-            self.command_queue.put(MonitorCommand(
-                "translate",
+            self.queue_command(MonitorCommand(
+                "parallel",
                 self.ui_sentence,
                 self.history[:],
-                temp=settings.get_setting_fallback('translate_best_of_three.third_temperature', .7),
-                style="Aim for a natural translation.",
-                index=3,
-                api_override=self.ai_service.get()))
+                subcommands=[
+                    MonitorCommand(
+                        "translate",
+                        self.ui_sentence,
+                        self.history[:],
+                        temp=settings.get_setting_fallback('translate_best_of_three.first_temperature', .7),
+                        index=1,
+                        api_override=self.ai_service.get()),
+                    MonitorCommand(
+                        "translate",
+                        self.ui_sentence,
+                        self.history[:],
+                        temp=settings.get_setting_fallback('translate_best_of_three.second_temperature', .7),
+                        style="Aim for a literal translation.",
+                        index=2,
+                        api_override=self.ai_service.get()),
+                    MonitorCommand(
+                        "translate",
+                        self.ui_sentence,
+                        self.history[:],
+                        temp=settings.get_setting_fallback('translate_best_of_three.third_temperature', .7),
+                        style="Aim for a natural translation.",
+                        index=3,
+                        api_override=self.ai_service.get()),
+                ]))
             if settings.get_setting_fallback('translate_best_of_three.enable_validation', False):
-                self.command_queue.put(MonitorCommand("translation_validation",
-                                                      self.ui_sentence,
-                                                      self.history[:],
-                                                      "",
-                                                      api_override=self.ai_service.get(),
-                                                      update_token_key="translation_validation"))
+                self.queue_command(MonitorCommand("translation_validation",
+                                                  self.ui_sentence,
+                                                  self.history[:],
+                                                  "",
+                                                  api_override=self.ai_service.get(),
+                                                  update_token_key="translation_validation"))
         elif style == TranslationType.ChainOfThought:
-            self.command_queue.put(MonitorCommand(
+            self.queue_command(MonitorCommand(
                 "translate_cot",
                 self.ui_sentence,
                 self.history[:],
@@ -446,19 +515,19 @@ class JpVocabUI:
                 update_token_key="translate"
             ))
         elif style == TranslationType.TranslateAndChainOfThought:
-            self.command_queue.put(MonitorCommand(
+            self.queue_command(MonitorCommand(
                 "translate",
                 self.ui_sentence,
                 self.history[:],
                 api_override=self.ai_service.get()))
-            self.command_queue.put(MonitorCommand(
+            self.queue_command(MonitorCommand(
                 "translate_cot",
                 self.ui_sentence,
                 self.history[:],
                 api_override=self.ai_service.get(),
                 update_token_key="translation_validation"))
         elif style == TranslationType.Define:
-            self.command_queue.put(MonitorCommand(
+            self.queue_command(MonitorCommand(
                 "define",
                 self.ui_sentence,
                 [],
@@ -466,12 +535,12 @@ class JpVocabUI:
         elif style == TranslationType.DefineWithoutAI:
             self.ui_definitions = get_definitions_string(self.ui_sentence)
         elif style == TranslationType.DefineAndChainOfThought:
-            self.command_queue.put(MonitorCommand(
+            self.queue_command(MonitorCommand(
                 "define",
                 self.ui_sentence,
                 [],
                 api_override=self.ai_service.get()))
-            self.command_queue.put(MonitorCommand(
+            self.queue_command(MonitorCommand(
                 "translate_cot",
                 self.ui_sentence,
                 self.history[:],
@@ -503,25 +572,27 @@ class JpVocabUI:
             self.perform_translation(TranslationType.Define)
 
     def ask_question(self):
-        request_interrupt_atomic_swap(True)
+        self.stop()
         self.ui_question = self.text_output_scrolled_text.get("1.0", tk.END)
         self.ui_response = ""
         self.show_qanda = True
-        self.command_queue.put(MonitorCommand("qanda", self.ui_sentence, self.history[:], self.ui_question,
-                                              temp=0, api_override=self.ai_service.get()))
+        # the question was typed into the text field, so it no longer matches what update_ui rendered
+        self.last_textfield_value = None
+        self.queue_command(MonitorCommand("qanda", self.ui_sentence, self.history[:], self.ui_question,
+                                          temp=0, api_override=self.ai_service.get()))
 
     def play_tts(self):
-        self.command_queue.put(MonitorCommand("tts", self.ui_sentence, self.history[:]))
+        self.queue_command(MonitorCommand("tts", self.ui_sentence, self.history[:]))
 
     def retry(self):
         with self.sentence_lock:
             if self.last_command:
-                if self.last_command.command_type == "translate":
-                    self.ui_translation = ""
+                if self.last_command.command_type in ["translate", "parallel"]:
+                    self.set_translation("")
                     self.ui_translation_validation = ""
                 if self.last_command.command_type == "translate_cot":
                     if self.last_command.update_token_key == "translate":
-                        self.ui_translation = ""
+                        self.set_translation("")
                     elif self.last_command.update_token_key == "translation_validation":
                         self.ui_translation_validation = ""
                 if self.last_command.command_type == "define":
@@ -529,14 +600,22 @@ class JpVocabUI:
                 if self.last_command.command_type == "qanda":
                     self.ui_response = ""
                 self.show_qanda = self.last_command.command_type == "qanda"
-                self.command_queue.put(self.last_command)
+                # the same prompt would otherwise replay the cached response
+                self.last_command.set_refresh(True)
+                self.queue_command(self.last_command)
 
-    @staticmethod
-    def stop():
-        request_interrupt_atomic_swap(True)
+    def stop(self):
+        self.cancel_token.cancel()
+        self.cancel_token = CancellationToken()
+
+    def queue_command(self, command: MonitorCommand):
+        command.set_cancel_token(self.cancel_token)
+        command.mark_enqueued()
+        self.command_queue.put(command)
 
     def switch_view(self):
         self.show_qanda = not self.show_qanda
+        self.last_textfield_value = None
 
     def show_history(self):
         # Create popup window
@@ -621,18 +700,34 @@ class JpVocabUI:
     # threading etc
 
     def start(self):
+        if settings.get_setting_fallback('define_into_analysis.enable_jmdict_replacements', False):
+            # extracting JMDict takes a while; do it now rather than on the first Define->Analysis
+            start_reading_index_build()
+        start_warm_up()
         self.start_processing_thread()
+        self.start_clipboard_source()
         self.start_ui()
 
+    def start_clipboard_source(self):
+        clipboard_source = create_clipboard_source(
+            settings.get_setting_fallback('clipboard.source', CLIPBOARD_SOURCE_AUTO),
+            poll_interval_ms=settings.get_setting_fallback('clipboard.poll_interval_ms', CLIPBOARD_CHECK_LATENCY_MS),
+            socket_port=settings.get_setting_fallback('clipboard.socket_port', 8765))
+        clipboard_source.start(self.clipboard_queue.put)
+
     def start_processing_thread(self):
         thread = threading.Thread(target=self.processing_thread, args=(self.command_queue,))
         thread.daemon = True
         thread.start()
 
     def processing_thread(self, queue: SimpleQueue[MonitorCommand]):
+        executor = ThreadPoolExecutor(max_workers=max(1, settings.get_setting_fallback(
+            'ai_settings.max_parallel_commands', 3)))
         while True:
             command = queue.get(block=True)  # type: MonitorCommand
             try:
+                if command.cancel_token is not None and command.cancel_token.is_cancelled:
+                    continue
                 with self.sentence_lock:
                     latest_sentence = self.locked_sentence
                     if command.sentence != latest_sentence:
@@ -640,96 +735,127 @@ class JpVocabUI:
                     if command.command_type != "translation_validation":
                         self.last_command = command
 
-                if command.command_type == "translate":
-                    translate_with_context(command.history,
-                                           command.sentence,
-                                           update_queue=self.ui_update_queue,
-                                           temp=command.temp,
-                                           index=command.index,
-                                           api_override=command.api_override)
-                    self.ui_update_queue.put(UIUpdateCommand("translate", command.sentence, "\n"))
-                if command.command_type == "translation_validation":
-                    prompt = (f"{self.ui_sentence}\n\n{self.ui_translation}\n\n"
-                              f"Which translation is most accurate? Or are they equivalent?")
-                    command.prompt = prompt
-                    ask_question(command.prompt, command.sentence, command.history, temp=command.temp,
-                                 update_queue=self.ui_update_queue, update_token_key=command.update_token_key,
-                                 api_override=command.api_override)
-                if command.command_type == "translate_cot":
-                    suggested_readings = None
-                    if command.include_readings:
-                        if not self.ui_update_queue.empty():
-                            time.sleep(3 * UPDATE_LOOP_LATENCY_MS / 1000.0)
-                        suggested_readings = self.ui_definitions
-                        self.ui_definitions = ""
-                    translate_with_context_cot(command.history,
-                                               command.sentence,
-                                               update_queue=self.ui_update_queue,
-                                               temp=command.temp,
-                                               update_token_key=command.update_token_key,
-                                               api_override=command.api_override,
-                                               suggested_readings=suggested_readings)
-                    self.ui_update_queue.put(UIUpdateCommand(command.update_token_key, command.sentence, "\n"))
-                if command.command_type == "define":
-                    run_vocabulary_list(command.sentence, temp=command.temp,
-                                        update_queue=self.ui_update_queue, api_override=command.api_override)
-                if command.command_type == "qanda":
-                    ask_question(command.prompt, command.sentence, command.history, temp=command.temp,
-                                 update_queue=self.ui_update_queue, api_override=command.api_override)
-                if command.command_type == "tts":
-                    generate_tts(command.sentence)
-            except Empty:
-                pass
+                if command.command_type == "parallel":
+                    # the subcommands are independent, so they run at the same time; later commands still wait
+                    wait([executor.submit(self.run_command, subcommand) for subcommand in command.subcommands])
+                else:
+                    self.run_command(command)
             except Exception as e:
                 print(e)
                 logging.error(f"Exception while running command: {e}")
 
-    def update_status(self, root: tk.Tk):
-        current_time_ms = time.time()
-        if (current_time_ms - self.last_clipboard_ts)*1000 > CLIPBOARD_CHECK_LATENCY_MS:
-            try:
-                self.check_clipboard()
-                self.last_clipboard_ts = current_time_ms
-            except pyperclip.PyperclipWindowsException as e:
-                print(ANSIColors.RED, end="")
-                print("EXCEPTION!")
-                print(e)
-                print(ANSIColors.END, end="")
-                logging.error(f"Exception from pyperclip: {e}")
+    def run_command(self, command: MonitorCommand):
+        with command_context(command.command_type, command.enqueue_time):
+            self._run_command(command)
 
+    def _run_command(self, command: MonitorCommand):
         try:
-            while True:
-                self.consume_update()
-        except Empty:
-            pass
+            if command.command_type == "translate":
+                translate_with_context(command.history,
+                                       command.sentence,
+                                       update_queue=self.ui_update_queue,
+                                       temp=command.temp,
+                                       index=command.index,
+                                       api_override=command.api_override,
+                                       cancel_token=command.cancel_token,
+                                       refresh=command.refresh)
+                self.ui_update_queue.put(UIUpdateCommand("translate", command.sentence, "\n", command.index))
+            if command.command_type == "translation_validation":
+                prompt = (f"{self.ui_sentence}\n\n{self.ui_translation}\n\n"
+                          f"Which translation is most accurate? Or are they equivalent?")
+                command.prompt = prompt
+                ask_question(command.prompt, command.sentence, command.history, temp=command.temp,
+                             update_queue=self.ui_update_queue, update_token_key=command.update_token_key,
+                             api_override=command.api_override, cancel_token=command.cancel_token,
+                             refresh=command.refresh)
+            if command.command_type == "translate_cot":
+                suggested_readings = None
+                if command.include_readings:
+                    if not self.ui_update_queue.empty():
+                        time.sleep(3 * UPDATE_LOOP_LATENCY_MS / 1000.0)
+                    suggested_readings = self.ui_definitions
+                    self.ui_definitions = ""
+                translate_with_context_cot(command.history,
+                                           command.sentence,
+                                           update_queue=self.ui_update_queue,
+                                           temp=command.temp,
+                                           update_token_key=command.update_token_key,
+                                           api_override=command.api_override,
+                                           suggested_readings=suggested_readings,
+                                           cancel_token=command.cancel_token,
+                                           refresh=command.refresh)
+                self.ui_update_queue.put(UIUpdateCommand(command.update_token_key, command.sentence, "\n"))
+            if command.command_type == "define":
+                run_vocabulary_list(command.sentence, temp=command.temp,
+                                    update_queue=self.ui_update_queue, api_override=command.api_override,
+                                    cancel_token=command.cancel_token, refresh=command.refresh)
+            if command.command_type == "qanda":
+                ask_question(command.prompt, command.sentence, command.history, temp=command.temp,
+                             update_queue=self.ui_update_queue, api_override=command.api_override,
+                             cancel_token=command.cancel_token, refresh=command.refresh)
+            if command.command_type == "tts":
+                generate_tts(command.sentence)
+        except Exception as e:
+            print(e)
+            logging.error(f"Exception while running command: {e}")
 
-        self.update_ui()
-        root.after(UPDATE_LOOP_LATENCY_MS, lambda: self.update_status(root))
+    def update_status(self, root: tk.Tk):
+        try:
+            self.drain_clipboard_queue()
+
+            for update_command in self.ui_update_queue.drain():
+                self.consume_update(update_command)
+
+            metrics_summary = get_latest_summary()
+            if metrics_summary != self.metrics_summary.get():
+                self.metrics_summary.set(metrics_summary)
+            reading_index_status = get_reading_index_status()
+            if reading_index_status != self.reading_index_status.get():
+                self.reading_index_status.set(reading_index_status)
+
+            self.update_ui()
+        except Exception as e:
+            logging.error(f"Exception while updating the UI: {e}")
+        finally:
+            # an error must never stop the loop
+            root.after(UPDATE_LOOP_LATENCY_MS, lambda: self.update_status(root))
+
+    def drain_clipboard_queue(self):
+        while True:
+            try:
+                current_clipboard = self.clipboard_queue.get_nowait()
+            except Empty:
+                return
+            try:
+                self.check_clipboard(current_clipboard)
+            except Exception as e:
+                # skip the line, but keep going with the rest of a burst
+                logging.error(f"Exception while checking clipboard line {current_clipboard!r}: {e}")
 
-    def check_clipboard(self):
-        current_clipboard = pyperclip.paste()
+    def check_clipboard(self, current_clipboard: str):
         current_clipboard = undo_repetition(current_clipboard)
         if current_clipboard != self.previous_clipboard:
             japanese_detected = should_generate_vocabulary_list(sentence=current_clipboard)
-            is_editing_textfield = (current_clipboard in self.last_textfield_value
+            # last_textfield_value is None until update_ui renders the text field again (e.g. after switching
+            # sentences or views), and several lines can arrive before that
+            is_editing_textfield = (self.last_textfield_value is not None
+                                    and current_clipboard in self.last_textfield_value
                                     and self.tk_root.focus_get() == self.text_output_scrolled_text)
             if japanese_detected and not is_editing_textfield:
                 if not any([(current_clipboard in previous or previous in current_clipboard) for previous in
                             self.history]):
                     self.history.append(current_clipboard)
                 next_sentence = current_clipboard
-                request_interrupt_atomic_swap(True)
+                self.stop()
 
                 if self.history_states:
                     # if the current sentence was the most recent sentence, update its history state before we move on
                     if self.ui_sentence == self.history_states[len(self.history_states) - 1].ui_sentence:
-                        history_state = HistoryState(self.ui_sentence, self.ui_translation,
-                                                     self.ui_translation_validation, self.ui_definitions,
-                                                     self.ui_question, self.ui_response, self.history[:])
-                        self.history_states[len(self.history_states) - 1] = history_state
+                        self.history_states[len(self.history_states) - 1] = self.get_current_history_state()
 
                     # since we could be _anywhere_ in history, snap to the latest history
-                    self.history = self.history_states[len(self.history_states) - 1].history
+                    self.history = self.history_states.get_history(
+                        self.history_states[len(self.history_states) - 1].history_ids)
 
                 # a sentence can be split across lines for _dramatic_ purpose, so un-split them if possible
                 connectors = [["「", "」",], ["『", "』"]]
@@ -744,7 +870,7 @@ class JpVocabUI:
 
                 self.ui_sentence = next_sentence
                 self.ui_definitions = ""
-                self.ui_translation = ""
+                self.set_translation("")
                 self.ui_translation_validation = ""
                 self.ui_question = ""
                 self.ui_response = ""
@@ -753,15 +879,13 @@ class JpVocabUI:
                     self.locked_sentence = next_sentence
 
                 logging.info(f"New sentence: {next_sentence}")
-                self.trigger_auto_behavior()
-                self.history = self.history[-self.history_length:]
+                if not self.apply_prefetched_translation():
+                    self.trigger_auto_behavior()
+                self.history = trim_history(self.history, self.history_length)
 
                 # each time we add a new sentence, we add a placeholder for it to HistoryStates
                 # we'll overwrite it when the next sentence comes in, OR when we got back/forward
-                self.history_states.append(
-                    HistoryState(self.ui_sentence, self.ui_translation, self.ui_translation_validation,
-                                 self.ui_definitions, self.ui_question, self.ui_response, self.history[:])
-                )
+                self.history_states.append(self.get_current_history_state())
                 self.history_states_index = len(self.history_states) - 1
 
                 cache_file = os.path.join("translation_history", f"{self.source}.json")
@@ -773,12 +897,50 @@ class JpVocabUI:
 
         self.previous_clipboard = current_clipboard
 
-    def consume_update(self):
-        # throws Empty if no elements
-        update_command = self.ui_update_queue.get(False)  # type: UIUpdateCommand
+    def apply_prefetched_translation(self) -> bool:
+        """In script mode, shows the prefetched translation of the current sentence instead of requesting one."""
+        if self.script_prefetcher is None:
+            return False
+        if TranslationType(self.translation_style.get()) != TranslationType.Translate:
+            return False
+        self.script_prefetcher.advance_to(self.ui_sentence)
+        # so that retrying requests a fresh translation
+        live_command = MonitorCommand("translate", self.ui_sentence, self.history[:], index=1,
+                                      api_override=self.ai_service.get())
+        translation = self.script_prefetcher.get_translation(self.ui_sentence)
+        if translation is not None:
+            logging.info(f"Using prefetched translation: {translation}")
+            self.set_translation(f"#1. {translation}\n")
+            self.show_qanda = False
+            self.last_command = live_command
+            return True
+
+        sentence = self.ui_sentence
+
+        def on_prefetched(prefetched: Optional[str]):
+            # runs on the prefetch thread; the UI picks the translation up from the update queue
+            if prefetched is not None:
+                logging.info(f"Using prefetched translation: {prefetched}")
+                self.ui_update_queue.put(UIUpdateCommand("translate", sentence, f"#1. {prefetched}\n", 1))
+            else:
+                # ignored by the processing thread if the reader has moved on
+                self.queue_command(live_command)
+
+        # a second request for the line would wait behind the prefetch anyway
+        if self.script_prefetcher.wait_for_translation(sentence, on_prefetched):
+            logging.info(f"Waiting for the prefetch of: {sentence}")
+            self.show_qanda = False
+            self.last_command = live_command
+            return True
+        return False
+
+    def consume_update(self, update_command: UIUpdateCommand):
         if update_command.sentence == self.ui_sentence:
             if update_command.update_type == "translate":
-                self.ui_translation += update_command.token
+                index = update_command.index
+                self.ui_translation_sections[index] = self.ui_translation_sections.get(index, "") + update_command.token
+                self.ui_translation = "".join(self.ui_translation_sections[i]
+                                              for i in sorted(self.ui_translation_sections))
             if update_command.update_type == "translation_validation":
                 self.ui_translation_validation += update_command.token
             if update_command.update_type == "define":
@@ -786,17 +948,58 @@ class JpVocabUI:
             if update_command.update_type == "qanda":
                 self.ui_response += update_command.token
 
-    def update_ui(self):
+    def get_ui_regions(self) -> tuple[str, list[tuple[str, str]]]:
+        # returns the separator and the (tag, text) of each region of the current view
         if self.show_qanda:
-            textfield_value = f"{self.ui_question.strip()}\n{self.ui_response}"
-        else:
-            clean_translation = self.ui_translation.strip()
-            textfield_value = (f"{self.ui_sentence.strip()}\n\n{clean_translation}\n\n{self.ui_definitions}"
-                               f"\n\n{self.ui_translation_validation}")
-        if self.last_textfield_value is None or self.last_textfield_value != textfield_value:
-            self.text_output_scrolled_text.delete("1.0", tk.END)  # Clear current contents.
-            self.text_output_scrolled_text.insert(tk.INSERT, textfield_value)
-            self.last_textfield_value = textfield_value
+            return "\n", [("question", self.ui_question.strip()), ("response", self.ui_response)]
+        return "\n\n", [("sentence", self.ui_sentence.strip()),
+                        ("translation", self.ui_translation.strip()),
+                        ("definitions", self.ui_definitions),
+                        ("translation_validation", self.ui_translation_validation)]
+
+    def update_ui(self):
+        separator, regions = self.get_ui_regions()
+        if self.last_textfield_value is None or [tag for tag, _ in regions] != list(self.rendered_regions):
+            self.render_all_regions(separator, regions)
+            return
+
+        # while streaming, regions usually just grow; so only the new text is inserted
+        text_field = self.text_output_scrolled_text
+        changed = False
+        for tag, text in regions:
+            rendered = self.rendered_regions[tag]
+            if text == rendered:
+                continue
+            changed = True
+            if text.startswith(rendered):
+                text_field.insert(f"{tag}_end", text[len(rendered):], tag)
+            else:
+                text_field.delete(f"{tag}_start", f"{tag}_end")
+                text_field.insert(f"{tag}_end", text, tag)
+            self.rendered_regions[tag] = text
+        if changed:
+            self.last_textfield_value = separator.join(text for _, text in regions)
+
+    def render_all_regions(self, separator: str, regions: list[tuple[str, str]]):
+        text_field = self.text_output_scrolled_text
+        text_field.delete("1.0", tk.END)  # Clear current contents.
+        self.rendered_regions = {}
+        region_bounds = []
+        for i, (tag, text) in enumerate(regions):
+            if i > 0:
+                text_field.insert(tk.END, separator)
+            start = text_field.index("end-1c")
+            text_field.insert(tk.END, text, tag)
+            region_bounds.append((tag, start, text_field.index("end-1c")))
+            self.rendered_regions[tag] = text
+        # the marks bracket each region; text inserted at the end mark pushes it (but not the start mark) along.
+        # they're only placed once everything is inserted, so that they aren't pushed along by the later regions.
+        for tag, start, end in region_bounds:
+            text_field.mark_set(f"{tag}_start", start)
+            text_field.mark_gravity(f"{tag}_start", tk.LEFT)
+            text_field.mark_set(f"{tag}_end", end)
+            text_field.mark_gravity(f"{tag}_end", tk.RIGHT)
+        self.last_textfield_value = separator.join(text for _, text in regions)
 
 
 def undo_repetition(input_string):
@@ -825,6 +1028,8 @@ def undo_repetition(input_string):
 
 
 def generate_tts(sentence):
+    # the speech sdk is only loaded once TTS is used (or warmed up, see library.warm_up)
+    import azure.cognitiveservices.speech as speechsdk
     speech_config = speechsdk.SpeechConfig(subscription=settings.get_setting('azure_tts.speech_key'),
                                            region=settings.get_setting('azure_tts.speech_region'))
     audio_config = speechsdk.audio.AudioOutputConfig(use_default_speaker=True)
@@ -844,19 +1049,34 @@ def generate_tts(sentence):
 
 if __name__ == '__main__':
     source_tag = None
+    script_path = None
 
     if not source_tag:
         parser = argparse.ArgumentParser()
-        parser.add_argument("source",
+        parser.add_argument("source", nargs="?",
                             help="The name associated with each 'translation history'. Providing a unique name for each"
                             " allows for tracking each translation history separately when switching sources.",
                             type=str)
+        parser.add_argument("--script",
+                            help="A text file with the lines being read (e.g. an extracted game script), or a JSONL file with a"
+                            " 'text' field per line. The next lines"
+                            " will be translated ahead of time when the auto-action is 'Translate'.",
+                            type=str)
+        parser.add_argument("--profile-startup", action="store_true",
+                            help="Print how long each module takes to import at startup, then exit.")
         parser_args = parser.parse_args()
+        if parser_args.profile_startup:
+            print(profile_startup())
+            exit(0)
+        if not parser_args.source:
+            parser.error("the following arguments are required: source")
         source_tag = parser_args.source
+        script_path = parser_args.script
 
     source_settings_path = os.path.join("settings", f"{source_tag}.toml")
     if os.path.isfile(source_settings_path):
         settings.override_settings(source_settings_path)
+    set_namespace(source_tag)
 
-    monitor_ui = JpVocabUI(source_tag)
+    monitor_ui = JpVocabUI(source_tag, script_path)
     monitor_ui.start()
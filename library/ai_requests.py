@@ -1,32 +1,155 @@
+from functools import partial
 import requests
+import requests.adapters
 import json
-import os
-from typing import Optional
+from typing import Callable, Optional, TYPE_CHECKING
 import sseclient
-import google.generativeai as google_genai
 import urllib3
 import certifi
 import logging
+from threading import BoundedSemaphore, Lock
 
-from library.settings_manager import settings, ROOT_FOLDER
+from library.settings_manager import settings
+from library.request_metrics import track_request
+from library.response_recorder import record_response
 from library.token_count import get_token_count
 
+if TYPE_CHECKING:
+    import google.generativeai as google_genai
+
 AI_SERVICE_OOBABOOGA = "Oogabooga"
 AI_SERVICE_OPENAI = "OpenAI"
 AI_SERVICE_GEMINI = "Gemini"
 
+# ai_settings.streaming_core
+STREAMING_CORE_THREADS = "threads"
+STREAMING_CORE_ASYNC = "async"
+
+AI_SERVICE_SETTINGS_SECTIONS = {
+    AI_SERVICE_OOBABOOGA: "oobabooga_api",
+    AI_SERVICE_OPENAI: "openai_api",
+    AI_SERVICE_GEMINI: "gemini_pro_api",
+}
+
+_backend_semaphores = {}  # type: dict[str, BoundedSemaphore]
+_backend_semaphores_lock = Lock()
+
+# connections are kept alive and shared between requests (and threads), rather than reconnecting every time
+_http_clients_lock = Lock()
+_ooba_session = None  # type: Optional[requests.Session]
+_http_client = None  # type: Optional[urllib3.PoolManager]
+_gemini_api_key = None  # type: Optional[str]
+_gemini_models = {}  # type: dict[str, google_genai.GenerativeModel]
+
 
 class EmptyResponseException(ValueError):
     pass
 
 
+class CancellationToken:
+    """
+    Cancels the AI requests it is passed to. Cancelling also closes their open connections, so that the server
+    stops generating right away instead of when the next token arrives.
+    """
+    def __init__(self):
+        self._cancelled = False
+        self._lock = Lock()
+        self._close_callbacks = []  # type: list[Callable[[], None]]
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self._cancelled
+
+    def cancel(self):
+        with self._lock:
+            if self._cancelled:
+                return
+            self._cancelled = True
+            callbacks, self._close_callbacks = self._close_callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logging.warning(f"Error while closing a cancelled request: {e}")
+
+    def register_close(self, callback: Callable[[], None]):
+        with self._lock:
+            if not self._cancelled:
+                self._close_callbacks.append(callback)
+                return
+        callback()
+
+    def unregister_close(self, callback: Callable[[], None]):
+        with self._lock:
+            if callback in self._close_callbacks:
+                self._close_callbacks.remove(callback)
+
+
+def _abort_response(response: urllib3.BaseHTTPResponse):
+    # shutdown (urllib3 >= 2.3) unblocks a read that's in progress on another thread; close is the fallback
+    shutdown = getattr(response, "shutdown", None)
+    if shutdown is not None:
+        shutdown()
+    else:
+        response.close()
+
+
+def get_request_timeout() -> tuple[float, float]:
+    return (settings.get_setting_fallback('ai_settings.connect_timeout_seconds', 10),
+            settings.get_setting_fallback('ai_settings.read_timeout_seconds', 120))
+
+
 def create_http_client():
+    connect_timeout, read_timeout = get_request_timeout()
     return urllib3.PoolManager(
+        maxsize=settings.get_setting_fallback('ai_settings.connection_pool_size', 4),
+        timeout=urllib3.Timeout(connect=connect_timeout, read=read_timeout),
         cert_reqs="CERT_REQUIRED",
         ca_certs=certifi.where()
     )
 
 
+def get_http_client() -> urllib3.PoolManager:
+    global _http_client
+    with _http_clients_lock:
+        if _http_client is None:
+            _http_client = create_http_client()
+        return _http_client
+
+
+def get_ooba_session() -> requests.Session:
+    global _ooba_session
+    with _http_clients_lock:
+        if _ooba_session is None:
+            pool_size = settings.get_setting_fallback('ai_settings.connection_pool_size', 4)
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            _ooba_session = requests.Session()
+            _ooba_session.mount("http://", adapter)
+            _ooba_session.mount("https://", adapter)
+        return _ooba_session
+
+
+def get_gemini_model(api_key: str, model_name: str) -> "google_genai.GenerativeModel":
+    # google.generativeai takes about a second to import, so it's only loaded once Gemini is used
+    import google.generativeai as google_genai
+    global _gemini_api_key
+    with _http_clients_lock:
+        # the api key is configured globally, so the models are only rebuilt if it changes
+        if api_key != _gemini_api_key:
+            google_genai.configure(api_key=api_key)
+            _gemini_api_key = api_key
+            _gemini_models.clear()
+        if model_name not in _gemini_models:
+            _gemini_models[model_name] = google_genai.GenerativeModel(model_name,
+                                                                      safety_settings={
+                                                                          "harassment": "block_none",
+                                                                          "hate_speech": "block_none",
+                                                                          "sexually_explicit": "block_none",
+                                                                          "dangerous": "block_none",
+                                                                      })
+        return _gemini_models[model_name]
+
+
 def run_ai_request(prompt: str, custom_stopping_strings: Optional[list[str]] = None, temperature: float = .1,
                    clean_blank_lines: bool = True, max_response: int = 2048, ban_eos_token: bool = True,
                    print_prompt=True):
@@ -41,35 +164,100 @@ def run_ai_request(prompt: str, custom_stopping_strings: Optional[list[str]] = N
     return result
 
 
+def get_backend_semaphore(api_choice: str) -> BoundedSemaphore:
+    """Limits how many requests can be in flight at once for each service."""
+    with _backend_semaphores_lock:
+        if api_choice not in _backend_semaphores:
+            section = AI_SERVICE_SETTINGS_SECTIONS.get(api_choice)
+            limit = 1
+            if section:
+                limit = max(1, settings.get_setting_fallback(f'{section}.max_concurrent_requests', 1))
+            _backend_semaphores[api_choice] = BoundedSemaphore(limit)
+        return _backend_semaphores[api_choice]
+
+
 def run_ai_request_stream(prompt: str, custom_stopping_strings: Optional[list[str]] = None, temperature: float = .1,
                           max_response: int = 2048, ban_eos_token: bool = True, print_prompt=True,
-                          api_override: Optional[str] = None):
-    api_choice = settings.get_setting('ai_settings.api')
-    if api_override:
-        api_choice = api_override
+                          api_override: Optional[str] = None, cancel_token: Optional[CancellationToken] = None,
+                          prompt_token_count: Optional[int] = None):
+    """prompt_token_count can be passed when it's already known (e.g. from packing the history), to skip recounting."""
+    if cancel_token is None:
+        cancel_token = CancellationToken()
+    yield from track_request(
+        _run_ai_request_stream_with_core(prompt, custom_stopping_strings, temperature, max_response, ban_eos_token,
+                                         print_prompt, api_override, cancel_token, prompt_token_count),
+        get_api_choice(api_override), prompt, prompt_token_count, cancel_token)
+
+
+def _run_ai_request_stream_with_core(prompt: str, custom_stopping_strings: Optional[list[str]], temperature: float,
+                                     max_response: int, ban_eos_token: bool, print_prompt: bool,
+                                     api_override: Optional[str], cancel_token: CancellationToken,
+                                     prompt_token_count: Optional[int]):
+    if settings.get_setting_fallback('ai_settings.streaming_core', STREAMING_CORE_THREADS) == STREAMING_CORE_ASYNC:
+        # imported here since ai_requests_async builds on this module
+        from library.ai_requests_async import run_ai_request_stream_sync
+        yield from run_ai_request_stream_sync(prompt, custom_stopping_strings, temperature, max_response,
+                                              ban_eos_token, print_prompt, api_override, cancel_token,
+                                              prompt_token_count)
+        return
+    api_choice = get_api_choice(api_override)
+    with get_backend_semaphore(api_choice):
+        if cancel_token.is_cancelled:
+            return
+        yield from record_response(
+            _run_ai_request_stream(api_choice, prompt, custom_stopping_strings, temperature, max_response,
+                                   ban_eos_token, print_prompt, cancel_token, prompt_token_count),
+            api_choice, prompt, cancel_token)
+
+
+def _run_ai_request_stream(api_choice: str, prompt: str, custom_stopping_strings: Optional[list[str]],
+                           temperature: float, max_response: int, ban_eos_token: bool, print_prompt: bool,
+                           cancel_token: CancellationToken, prompt_token_count: Optional[int] = None):
     if api_choice == AI_SERVICE_OOBABOOGA:
         for tok in run_ai_request_ooba(prompt, custom_stopping_strings, temperature, max_response, ban_eos_token,
-                                       print_prompt):
+                                       print_prompt, cancel_token, prompt_token_count):
             yield tok
     elif api_choice == AI_SERVICE_OPENAI:
         for tok in run_ai_request_openai(prompt, custom_stopping_strings, temperature, max_response,
-                                         print_prompt):
+                                         print_prompt, cancel_token):
             yield tok
     elif api_choice == AI_SERVICE_GEMINI:
-        for chunk in run_ai_request_gemini_pro(prompt, custom_stopping_strings, temperature, max_response):
+        for chunk in run_ai_request_gemini_pro(prompt, custom_stopping_strings, temperature, max_response,
+                                               cancel_token):
             yield chunk
     else:
         logging.error(f"{api_choice} is unsupported for the setting ai_settings.api")
         raise ValueError(f"{api_choice} is unsupported for the setting ai_settings.api")
 
 
-def run_ai_request_ooba(prompt: str, custom_stopping_strings: Optional[list[str]] = None, temperature: float = .1,
-                        max_response: int = 2048, ban_eos_token: bool = True, print_prompt=True):
+def get_api_choice(api_override: Optional[str] = None) -> str:
+    if api_override:
+        return api_override
+    return settings.get_setting('ai_settings.api')
+
+
+def get_model_identifier(api_choice: str) -> str:
+    """Best-effort description of the model that will answer a request; used to tell cached responses apart."""
+    if api_choice == AI_SERVICE_OOBABOOGA:
+        # the loaded model isn't exposed in the settings, so the endpoint and preset stand in for it
+        return (f"{settings.get_setting('oobabooga_api.request_url')}|"
+                f"{settings.get_setting('oobabooga_api.preset_name')}")
+    elif api_choice == AI_SERVICE_OPENAI:
+        return f"{settings.get_setting('openai_api.request_url')}|{settings.get_setting('openai_api.model')}"
+    elif api_choice == AI_SERVICE_GEMINI:
+        return settings.get_setting('gemini_pro_api.api_model')
+    return ""
+
+
+def build_ooba_request(prompt: str, custom_stopping_strings: Optional[list[str]], temperature: float,
+                       max_response: int, ban_eos_token: bool,
+                       prompt_token_count: Optional[int] = None) -> tuple[str, dict, dict]:
+    """The url, headers and json body of an Oobabooga request; shared with the async backend."""
     request_url = settings.get_setting('oobabooga_api.request_url')
     max_context = settings.get_setting('oobabooga_api.context_length')
     if not custom_stopping_strings:
         custom_stopping_strings = []
-    prompt_length = get_token_count(prompt)
+    prompt_length = prompt_token_count if prompt_token_count is not None else get_token_count(prompt)
     if prompt_length + max_response > max_context:
         logging.error(f"run_ai_request: the prompt ({prompt_length}) and response length ({max_response}) are "
                       f"longer than max context! ({max_context})")
@@ -122,22 +310,45 @@ def run_ai_request_ooba(prompt: str, custom_stopping_strings: Optional[list[str]
             'top_p': 0.98,
         }
         data.update(extra_settings)
+    if settings.get_setting_fallback('oobabooga_api.cache_prompt', False):
+        data['cache_prompt'] = True
+    return request_url, headers, data
+
+
+def run_ai_request_ooba(prompt: str, custom_stopping_strings: Optional[list[str]] = None, temperature: float = .1,
+                        max_response: int = 2048, ban_eos_token: bool = True, print_prompt=True,
+                        cancel_token: Optional[CancellationToken] = None, prompt_token_count: Optional[int] = None):
+    if cancel_token is None:
+        cancel_token = CancellationToken()
+    request_url, headers, data = build_ooba_request(prompt, custom_stopping_strings, temperature, max_response,
+                                                    ban_eos_token, prompt_token_count)
 
-    stream_response = requests.post(request_url, headers=headers, json=data, verify=False, stream=True)
+    stream_response = get_ooba_session().post(request_url, headers=headers, json=data, verify=False, stream=True,
+                                              timeout=get_request_timeout())
+    close_callback = partial(_abort_response, stream_response.raw)
+    cancel_token.register_close(close_callback)
     client = sseclient.SSEClient(stream_response)
 
     if print_prompt:
         print(data['prompt'], end='')
-    with open(os.path.join(ROOT_FOLDER, "response.txt"), "w", encoding='utf-8') as f:
+    try:
         for event in client.events():
+            if cancel_token.is_cancelled:
+                break
             payload = json.loads(event.data)
-            new_text = payload['choices'][0]['text']
-            f.write(new_text)
-            yield new_text
+            yield payload['choices'][0]['text']
+    except Exception:
+        # reading from the aborted connection fails; that's expected when the request was cancelled
+        if not cancel_token.is_cancelled:
+            raise
+    finally:
+        cancel_token.unregister_close(close_callback)
+        stream_response.close()
 
 
-def run_ai_request_openai(prompt: str, custom_stopping_strings: Optional[list[str]] = None, temperature: float = .1,
-                          max_response: int = 2048, print_prompt=True):
+def build_openai_request(prompt: str, custom_stopping_strings: Optional[list[str]], temperature: float,
+                         max_response: int) -> tuple[str, dict, dict]:
+    """The url, headers and json body of an OpenAI request; shared with the async backend."""
     request_url = settings.get_setting('openai_api.request_url')
     data = {
         "model": settings.get_setting('openai_api.model'),
@@ -154,59 +365,94 @@ def run_ai_request_openai(prompt: str, custom_stopping_strings: Optional[list[st
         "temperature": temperature,
         "top_p": 1
     }
+    if settings.get_setting_fallback('openai_api.cache_prompt', False):
+        data['cache_prompt'] = True
     api_key = settings.get_setting('openai_api.api_key')
     headers = {
         'Content-Type': 'application/json',
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {api_key}'
+        'Accept': 'application/json'
     }
-    http = create_http_client()
+    # local servers often don't need a key, and httpx rejects the header value 'Bearer ' (trailing space)
+    if api_key:
+        headers['Authorization'] = f'Bearer {api_key}'
+    return request_url, headers, data
+
+
+def run_ai_request_openai(prompt: str, custom_stopping_strings: Optional[list[str]] = None, temperature: float = .1,
+                          max_response: int = 2048, print_prompt=True,
+                          cancel_token: Optional[CancellationToken] = None):
+    if cancel_token is None:
+        cancel_token = CancellationToken()
+    request_url, headers, data = build_openai_request(prompt, custom_stopping_strings, temperature, max_response)
+    http = get_http_client()
     stream_response = http.request(
         'POST',
         request_url,
         headers=headers,
         body=json.dumps(data),
         preload_content=False)
+    close_callback = partial(_abort_response, stream_response)
+    cancel_token.register_close(close_callback)
     client = sseclient.SSEClient(stream_response)
 
     if print_prompt:
         print(data['prompt'], end='')
-    with open(os.path.join(ROOT_FOLDER, "response.txt"), "w", encoding='utf-8') as f:
-        for event in client.events():
+    finished = False
+    # kept referenced until the connection is released; dropping it early closes the response
+    events = client.events()
+    try:
+        for event in events:
+            if cancel_token.is_cancelled:
+                break
             if event.data == "[DONE]":
+                finished = True
                 break
             payload = json.loads(event.data)
-            new_text = payload['choices'][0]['text']
-            f.write(new_text)
-            yield new_text
+            yield payload['choices'][0]['text']
+        else:
+            finished = True
+    except Exception:
+        # reading from the aborted connection fails; that's expected when the request was cancelled
+        if not cancel_token.is_cancelled:
+            raise
+    finally:
+        cancel_token.unregister_close(close_callback)
+        if finished:
+            # only a fully read connection can go back to the pool for reuse
+            stream_response.drain_conn()
+            stream_response.release_conn()
+        else:
+            stream_response.close()
 
 
-def run_ai_request_gemini_pro(prompt: str, custom_stopping_strings: Optional[list[str]] = None, temperature: float = .1,
-                              max_response: int = 2048):
-    google_genai.configure(api_key=settings.get_setting('gemini_pro_api.api_key'))
-    model = google_genai.GenerativeModel(settings.get_setting('gemini_pro_api.api_model'),
-                                         safety_settings={
-                                              "harassment": "block_none",
-                                              "hate_speech": "block_none",
-                                              "sexually_explicit": "block_none",
-                                              "dangerous": "block_none",
-                                         },
-                                         generation_config={
-                                              "temperature": temperature,
-                                              "stop_sequences": custom_stopping_strings,
-                                              "max_output_tokens": max_response,
-                                         })
+def build_gemini_request(prompt: str, custom_stopping_strings: Optional[list[str]], temperature: float,
+                         max_response: int) -> tuple["google_genai.GenerativeModel", list[dict], dict]:
+    """The model, contents and generation config of a Gemini request; shared with the async backend."""
+    model = get_gemini_model(settings.get_setting('gemini_pro_api.api_key'),
+                             settings.get_setting('gemini_pro_api.api_model'))
 
     system_prompt = settings.get_setting('gemini_pro_api.system_prompt')
     contents = [
         {"role": "user", "parts": [system_prompt]},
         {"role": "user", "parts": [prompt]},
     ]
+    generation_config = {
+        "temperature": temperature,
+        "stop_sequences": custom_stopping_strings,
+        "max_output_tokens": max_response,
+    }
+    return model, contents, generation_config
+
 
-    response = model.generate_content(contents, stream=True)
+def run_ai_request_gemini_pro(prompt: str, custom_stopping_strings: Optional[list[str]] = None, temperature: float = .1,
+                              max_response: int = 2048, cancel_token: Optional[CancellationToken] = None):
+    model, contents, generation_config = build_gemini_request(prompt, custom_stopping_strings, temperature,
+                                                              max_response)
+    response = model.generate_content(contents, generation_config=generation_config, stream=True)
 
-    with open(os.path.join(ROOT_FOLDER, "response.txt"), "w", encoding='utf-8') as f:
-        for chunk in response:
-            if chunk.text:
-                f.write(chunk.text)
-                yield chunk.text
+    for chunk in response:
+        # the streaming response can't be closed early, so cancellation is only noticed between chunks
+        if cancel_token is not None and cancel_token.is_cancelled:
+            break
+        if chunk.text:
+            yield chunk.text
@@ -0,0 +1,197 @@
+"""
+An asyncio version of the streaming requests in ai_requests, built on httpx. Each in-flight request is a coroutine
+rather than a blocked thread, so many requests (batch jobs, best-of-N) can stream at once.
+
+Native callers use 'async for tok in run_ai_request_stream_async(...)'. Existing (threaded) callers go through
+run_ai_request_stream_sync, which runs the request on a shared background event loop; ai_requests.run_ai_request_stream
+does that when ai_settings.streaming_core is "async".
+"""
+from queue import SimpleQueue
+from threading import Lock, Thread
+from typing import AsyncIterator, Iterator, Optional
+import asyncio
+import json
+import logging
+
+import httpx
+
+from library.ai_requests import (AI_SERVICE_GEMINI, AI_SERVICE_OOBABOOGA, AI_SERVICE_OPENAI,
+                                 AI_SERVICE_SETTINGS_SECTIONS, CancellationToken, build_gemini_request,
+                                 build_ooba_request, build_openai_request, get_api_choice, get_request_timeout)
+from library.response_recorder import record_response_async
+from library.settings_manager import settings
+
+# clients and semaphores belong to the event loop they were created on
+_loop_state_lock = Lock()
+_http_clients = {}  # type: dict[tuple[asyncio.AbstractEventLoop, bool], httpx.AsyncClient]
+_backend_semaphores = {}  # type: dict[tuple[asyncio.AbstractEventLoop, str], asyncio.Semaphore]
+
+_background_loop = None  # type: Optional[asyncio.AbstractEventLoop]
+_background_loop_lock = Lock()
+
+# marks the end of a stream in the sync adapter's queue
+_END_OF_STREAM = object()
+
+
+def get_async_http_client(verify: bool = True) -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    with _loop_state_lock:
+        if (loop, verify) not in _http_clients:
+            connect_timeout, read_timeout = get_request_timeout()
+            pool_size = settings.get_setting_fallback('ai_settings.connection_pool_size', 4)
+            _http_clients[(loop, verify)] = httpx.AsyncClient(
+                verify=verify,
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size))
+        return _http_clients[(loop, verify)]
+
+
+def get_async_backend_semaphore(api_choice: str) -> asyncio.Semaphore:
+    """The async counterpart of ai_requests.get_backend_semaphore, with the same max_concurrent_requests."""
+    loop = asyncio.get_running_loop()
+    with _loop_state_lock:
+        if (loop, api_choice) not in _backend_semaphores:
+            limit = 1
+            section = AI_SERVICE_SETTINGS_SECTIONS.get(api_choice)
+            if section:
+                limit = max(1, settings.get_setting_fallback(f'{section}.max_concurrent_requests', 1))
+            _backend_semaphores[(loop, api_choice)] = asyncio.Semaphore(limit)
+        return _backend_semaphores[(loop, api_choice)]
+
+
+async def _iter_sse_data(response: httpx.Response) -> AsyncIterator[str]:
+    """The 'data' of each server-sent event."""
+    data_lines = []
+    async for line in response.aiter_lines():
+        if not line:
+            if data_lines:
+                yield "\n".join(data_lines)
+                data_lines = []
+        elif line.startswith("data:"):
+            data_lines.append(line[5:].lstrip(" "))
+    if data_lines:
+        yield "\n".join(data_lines)
+
+
+async def run_ai_request_stream_async(prompt: str, custom_stopping_strings: Optional[list[str]] = None,
+                                      temperature: float = .1, max_response: int = 2048, ban_eos_token: bool = True,
+                                      print_prompt=True, api_override: Optional[str] = None,
+                                      cancel_token: Optional[CancellationToken] = None,
+                                      prompt_token_count: Optional[int] = None) -> AsyncIterator[str]:
+    """
+    Same parameters as ai_requests.run_ai_request_stream. The token is checked between tokens; to stop a request
+    that's waiting on the server, cancel the task that's iterating it.
+    """
+    api_choice = get_api_choice(api_override)
+    if cancel_token is None:
+        cancel_token = CancellationToken()
+    async with get_async_backend_semaphore(api_choice):
+        if cancel_token.is_cancelled:
+            return
+        if print_prompt:
+            print(prompt, end='')
+        if api_choice == AI_SERVICE_OOBABOOGA:
+            stream = run_ai_request_ooba_async(prompt, custom_stopping_strings, temperature, max_response,
+                                               ban_eos_token, prompt_token_count)
+        elif api_choice == AI_SERVICE_OPENAI:
+            stream = run_ai_request_openai_async(prompt, custom_stopping_strings, temperature, max_response)
+        elif api_choice == AI_SERVICE_GEMINI:
+            stream = run_ai_request_gemini_pro_async(prompt, custom_stopping_strings, temperature, max_response)
+        else:
+            logging.error(f"{api_choice} is unsupported for the setting ai_settings.api")
+            raise ValueError(f"{api_choice} is unsupported for the setting ai_settings.api")
+        stream = record_response_async(stream, api_choice, prompt, cancel_token)
+        try:
+            async for tok in stream:
+                if cancel_token.is_cancelled:
+                    break
+                yield tok
+        finally:
+            await stream.aclose()
+
+
+async def run_ai_request_ooba_async(prompt: str, custom_stopping_strings: Optional[list[str]] = None,
+                                    temperature: float = .1, max_response: int = 2048, ban_eos_token: bool = True,
+                                    prompt_token_count: Optional[int] = None) -> AsyncIterator[str]:
+    request_url, headers, data = build_ooba_request(prompt, custom_stopping_strings, temperature, max_response,
+                                                    ban_eos_token, prompt_token_count)
+    async with get_async_http_client(verify=False).stream("POST", request_url, headers=headers,
+                                                          json=data) as response:
+        response.raise_for_status()
+        async for event_data in _iter_sse_data(response):
+            payload = json.loads(event_data)
+            yield payload['choices'][0]['text']
+
+
+async def run_ai_request_openai_async(prompt: str, custom_stopping_strings: Optional[list[str]] = None,
+                                      temperature: float = .1, max_response: int = 2048) -> AsyncIterator[str]:
+    request_url, headers, data = build_openai_request(prompt, custom_stopping_strings, temperature, max_response)
+    async with get_async_http_client().stream("POST", request_url, headers=headers, json=data) as response:
+        response.raise_for_status()
+        async for event_data in _iter_sse_data(response):
+            if event_data == "[DONE]":
+                break
+            payload = json.loads(event_data)
+            yield payload['choices'][0]['text']
+
+
+async def run_ai_request_gemini_pro_async(prompt: str, custom_stopping_strings: Optional[list[str]] = None,
+                                          temperature: float = .1, max_response: int = 2048) -> AsyncIterator[str]:
+    model, contents, generation_config = build_gemini_request(prompt, custom_stopping_strings, temperature,
+                                                              max_response)
+    response = await model.generate_content_async(contents, generation_config=generation_config, stream=True)
+    async for chunk in response:
+        if chunk.text:
+            yield chunk.text
+
+
+def get_background_loop() -> asyncio.AbstractEventLoop:
+    global _background_loop
+    with _background_loop_lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            thread = Thread(target=_background_loop.run_forever)
+            thread.daemon = True
+            thread.start()
+        return _background_loop
+
+
+def run_ai_request_stream_sync(prompt: str, custom_stopping_strings: Optional[list[str]] = None,
+                               temperature: float = .1, max_response: int = 2048, ban_eos_token: bool = True,
+                               print_prompt=True, api_override: Optional[str] = None,
+                               cancel_token: Optional[CancellationToken] = None,
+                               prompt_token_count: Optional[int] = None) -> Iterator[str]:
+    """
+    A drop-in replacement for ai_requests.run_ai_request_stream that streams on the background event loop.
+    Cancelling the token cancels the request right away, even while it's waiting on the server.
+    """
+    if cancel_token is None:
+        cancel_token = CancellationToken()
+    tokens = SimpleQueue()
+
+    async def forward_tokens():
+        async for tok in run_ai_request_stream_async(prompt, custom_stopping_strings, temperature, max_response,
+                                                     ban_eos_token, print_prompt, api_override, cancel_token,
+                                                     prompt_token_count):
+            tokens.put(tok)
+
+    future = asyncio.run_coroutine_threadsafe(forward_tokens(), get_background_loop())
+    future.add_done_callback(lambda _: tokens.put(_END_OF_STREAM))
+    cancel_token.register_close(future.cancel)
+    try:
+        while True:
+            tok = tokens.get()
+            if tok is _END_OF_STREAM:
+                break
+            yield tok
+        if not future.cancelled():
+            try:
+                future.result()
+            except Exception:
+                # reading from the cancelled request fails; that's expected when the request was cancelled
+                if not cancel_token.is_cancelled:
+                    raise
+    finally:
+        cancel_token.unregister_close(future.cancel)
+        # stops the request if the caller stopped reading early
+        future.cancel()
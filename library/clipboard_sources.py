@@ -0,0 +1,160 @@
+"""
+Clipboard sources deliver newly copied (or pushed) text from a background thread, so that reading the clipboard never
+blocks the UI thread.
+"""
+from typing import Callable, Optional
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pyperclip
+
+CLIPBOARD_SOURCE_AUTO = "auto"
+CLIPBOARD_SOURCE_POLL = "poll"
+CLIPBOARD_SOURCE_X11 = "x11"
+CLIPBOARD_SOURCE_WAYLAND = "wayland"
+CLIPBOARD_SOURCE_SOCKET = "socket"
+CLIPBOARD_SOURCE_STDIN = "stdin"
+
+TextCallback = Callable[[str], None]
+
+
+class ClipboardSource:
+    def __init__(self):
+        self._on_text = None  # type: Optional[TextCallback]
+        self._stopped = threading.Event()
+
+    def start(self, on_text: TextCallback):
+        """Calls on_text (from a background thread) with each new piece of text."""
+        self._on_text = on_text
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        raise NotImplementedError()
+
+
+class ChangeDetectingClipboardSource(ClipboardSource):
+    """Base for sources that read the system clipboard, and only report it when it's different."""
+    def __init__(self):
+        super().__init__()
+        self._previous_text = None  # type: Optional[str]
+
+    def _read_clipboard(self):
+        try:
+            text = pyperclip.paste()
+        except pyperclip.PyperclipException as e:
+            logging.error(f"Exception from pyperclip: {e}")
+            return
+        if text != self._previous_text:
+            self._previous_text = text
+            self._on_text(text)
+
+
+class PollingClipboardSource(ChangeDetectingClipboardSource):
+    def __init__(self, interval_ms: int):
+        super().__init__()
+        self.interval_ms = interval_ms
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._read_clipboard()
+            self._stopped.wait(self.interval_ms / 1000.0)
+
+
+class X11ClipboardSource(ChangeDetectingClipboardSource):
+    """Waits for X11 selection changes with clipnotify (https://github.com/cdown/clipnotify)."""
+    def _run(self):
+        self._read_clipboard()
+        while not self._stopped.is_set():
+            # clipnotify exits as soon as the selection changes
+            result = subprocess.run(["clipnotify"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            if result.returncode != 0:
+                logging.error(f"clipnotify failed with exit code {result.returncode}")
+                time.sleep(1)
+                continue
+            self._read_clipboard()
+
+
+class WaylandClipboardSource(ChangeDetectingClipboardSource):
+    """Waits for Wayland clipboard changes with 'wl-paste --watch', which runs a command for every change."""
+    def _run(self):
+        self._read_clipboard()
+        process = subprocess.Popen(["wl-paste", "--watch", "echo"], stdout=subprocess.PIPE,
+                                   stderr=subprocess.DEVNULL, text=True)
+        for _ in process.stdout:
+            if self._stopped.is_set():
+                break
+            self._read_clipboard()
+        process.terminate()
+
+
+class SocketClipboardSource(ClipboardSource):
+    """
+    Accepts text pushed over a local TCP socket (e.g. from a text hooker), one UTF-8 line per sentence.
+    Try it with: echo "テスト" | nc 127.0.0.1 [port]
+    """
+    def __init__(self, port: int):
+        super().__init__()
+        self.port = port
+
+    def _run(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind(("127.0.0.1", self.port))
+            server.listen()
+            logging.info(f"Listening for text on 127.0.0.1:{self.port}")
+            while not self._stopped.is_set():
+                connection, _ = server.accept()
+                thread = threading.Thread(target=self._read_connection, args=(connection,))
+                thread.daemon = True
+                thread.start()
+
+    def _read_connection(self, connection: socket.socket):
+        with connection, connection.makefile("r", encoding="utf-8", errors="replace") as lines:
+            for line in lines:
+                if line.strip():
+                    self._on_text(line.rstrip("\r\n"))
+
+
+class StdinClipboardSource(ClipboardSource):
+    """Reads one sentence per line from stdin, e.g. when piping a text hooker's output into the app."""
+    def _run(self):
+        for line in sys.stdin:
+            if self._stopped.is_set():
+                break
+            if line.strip():
+                self._on_text(line.rstrip("\r\n"))
+
+
+def create_clipboard_source(source_type: str, poll_interval_ms: int, socket_port: int) -> ClipboardSource:
+    if source_type == CLIPBOARD_SOURCE_AUTO:
+        if os.environ.get("WAYLAND_DISPLAY") and shutil.which("wl-paste"):
+            source_type = CLIPBOARD_SOURCE_WAYLAND
+        elif os.environ.get("DISPLAY") and shutil.which("clipnotify"):
+            source_type = CLIPBOARD_SOURCE_X11
+        else:
+            source_type = CLIPBOARD_SOURCE_POLL
+        logging.info(f"Using the '{source_type}' clipboard source")
+
+    if source_type == CLIPBOARD_SOURCE_POLL:
+        return PollingClipboardSource(poll_interval_ms)
+    elif source_type == CLIPBOARD_SOURCE_X11:
+        return X11ClipboardSource()
+    elif source_type == CLIPBOARD_SOURCE_WAYLAND:
+        return WaylandClipboardSource()
+    elif source_type == CLIPBOARD_SOURCE_SOCKET:
+        return SocketClipboardSource(socket_port)
+    elif source_type == CLIPBOARD_SOURCE_STDIN:
+        return StdinClipboardSource()
+    logging.error(f"{source_type} is unsupported for the setting clipboard.source")
+    raise ValueError(f"{source_type} is unsupported for the setting clipboard.source")
@@ -0,0 +1,95 @@
+from typing import Callable, Optional
+import logging
+
+from library.ai_requests import get_api_choice, AI_SERVICE_SETTINGS_SECTIONS
+from library.prompt_templates import PromptTemplate
+from library.settings_manager import settings
+from library.token_count import get_token_count, get_token_counts
+
+HISTORY_KEY = "previous_lines"
+# tokens for the formatting around each history line (e.g. "- " and the newline), and for the history's header
+HISTORY_LINE_OVERHEAD_TOKENS = 3
+HISTORY_HEADER_TOKENS = 8
+# token counts of pieces are summed, which can be off by a few tokens from counting the whole prompt
+SAFETY_MARGIN_TOKENS = 16
+
+
+def get_stable_history_block_size() -> int:
+    return settings.get_setting_fallback('ai_settings.stable_history_block_size', 0)
+
+
+def trim_history(history: list[str], history_length: int, block_size: Optional[int] = None) -> list[str]:
+    """
+    Keeps the most recent history_length lines. With a block size, old lines are dropped block_size at a time
+    instead of one per new line; the history only grows at the end between drops, so consecutive prompts share a
+    long identical prefix that the AI service can reuse from its prompt cache.
+    """
+    if block_size is None:
+        block_size = get_stable_history_block_size()
+    if block_size <= 0:
+        return history[-history_length:]
+    excess = len(history) - (history_length + block_size - 1)
+    if excess <= 0:
+        return history
+    blocks = (excess + block_size - 1) // block_size
+    return history[blocks * block_size:]
+
+
+def get_history_start(index: int, history_length: int, block_size: Optional[int] = None) -> int:
+    """
+    Where the history for the line at index starts, when all the lines are known ahead of time (e.g. a script).
+    Matches trim_history: with a block size, the start only moves a block at a time.
+    """
+    if block_size is None:
+        block_size = get_stable_history_block_size()
+    start = max(0, index - history_length)
+    if block_size > 0:
+        start -= start % block_size
+    return start
+
+
+def get_context_budget(api_choice: str, max_response: int) -> Optional[int]:
+    """The number of prompt tokens that fit in the service's context, if it has a configured context_length."""
+    section = AI_SERVICE_SETTINGS_SECTIONS.get(api_choice)
+    if not section:
+        return None
+    context_length = settings.get_setting_fallback(f'{section}.context_length', None)
+    if context_length is None:
+        return None
+    return context_length - max_response
+
+
+def build_prompt_with_history(template: PromptTemplate, static_data: dict[str, str], dynamic_data: dict[str, str],
+                              history: list[str], format_history: Callable[[list[str]], str], max_response: int,
+                              api_override: Optional[str] = None) -> tuple[str, Optional[int]]:
+    """
+    Renders the template with as many of the most recent history lines as fit in the context.
+    Returns the prompt and an estimate of its token count (None if the service's context length isn't known).
+
+    Token counts are cached (see token_count), so the static prefix and history lines aren't re-tokenized.
+    """
+    budget = get_context_budget(get_api_choice(api_override), max_response)
+    if budget is None:
+        return template.render(static_data, {**dynamic_data, HISTORY_KEY: format_history(history)}), None
+
+    static_prefix, tail = template.render_parts(static_data, {**dynamic_data, HISTORY_KEY: format_history([])})
+    base_tokens = get_token_count(static_prefix) + get_token_count(tail)
+    available = budget - base_tokens - SAFETY_MARGIN_TOKENS
+
+    line_tokens = [count + HISTORY_LINE_OVERHEAD_TOKENS for count in get_token_counts(history)]
+    history_tokens = HISTORY_HEADER_TOKENS
+    start = len(history)
+    while start > 0 and history_tokens + line_tokens[start - 1] <= available:
+        start -= 1
+        history_tokens += line_tokens[start]
+    block_size = get_stable_history_block_size()
+    if block_size > 0 and start % block_size:
+        # drop whole blocks, so that the packed history starts on the same line for several requests in a row
+        start = min(len(history), start + block_size - start % block_size)
+        history_tokens = HISTORY_HEADER_TOKENS + sum(line_tokens[start:])
+    packed_history = history[start:]
+    if start > 0:
+        logging.info(f"Only {len(packed_history)} of {len(history)} history lines fit in the context.")
+
+    prompt = template.render(static_data, {**dynamic_data, HISTORY_KEY: format_history(packed_history)})
+    return prompt, base_tokens + (history_tokens if packed_history else 0)
@@ -0,0 +1,122 @@
+"""
+dictionary_index converts jitendex.json into a compact, sorted SQLite index that can be queried lazily.
+
+Loading the whole json into python dicts takes seconds and hundreds of MB; the index is memory-mapped by SQLite
+instead, so only the pages that are actually looked up are read.
+
+Build it ahead of time with:
+    python -m library.dictionary_index [--input data/jitendex.json] [--output data/jitendex.db]
+Otherwise, it is built automatically the first time a definition is looked up.
+"""
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import Iterable, Optional
+
+DEFAULT_JSON_PATH = os.path.join("data", "jitendex.json")
+DEFAULT_INDEX_PATH = os.path.join("data", "jitendex.db")
+MEANING_SEPARATOR = "\x1f"
+MMAP_SIZE_BYTES = 256 * 1024 * 1024
+# SQLite limits the number of parameters in a single query
+MAX_LOOKUP_BATCH = 500
+
+
+def build_dictionary_index(json_path: str = DEFAULT_JSON_PATH, index_path: str = DEFAULT_INDEX_PATH):
+    logging.info(f"Building dictionary index {index_path} from {json_path}")
+    with open(json_path, "r", encoding="utf-8") as f:
+        meaning_dict = json.load(f)
+
+    write_index(((word, entry.get("meanings", [])) for word, entry in meaning_dict.items()), index_path)
+    logging.info(f"Built dictionary index with {len(meaning_dict)} entries")
+
+
+def write_index(entries: Iterable[tuple[str, list[str]]], index_path: str):
+    """Writes (word, values) pairs in the format DictionaryIndex reads. The file is replaced once it's complete."""
+    tmp_path = index_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
+    connection = sqlite3.connect(tmp_path)
+    try:
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("CREATE TABLE entries (word TEXT PRIMARY KEY, meanings TEXT NOT NULL) WITHOUT ROWID")
+        # inserting in key order keeps the b-tree pages densely packed
+        rows = ((word, MEANING_SEPARATOR.join(values)) for word, values in sorted(entries))
+        connection.executemany("INSERT INTO entries (word, meanings) VALUES (?, ?)", rows)
+        connection.commit()
+        connection.execute("VACUUM")
+    finally:
+        connection.close()
+    os.replace(tmp_path, index_path)
+
+
+class DictionaryIndex:
+    """Read-only access to a dictionary index. Each thread gets its own SQLite connection."""
+    def __init__(self, index_path: str):
+        self.index_path = index_path
+        self._local = threading.local()
+
+    def _get_connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            uri = f"file:{os.path.abspath(self.index_path)}?mode=ro"
+            connection = sqlite3.connect(uri, uri=True)
+            connection.execute(f"PRAGMA mmap_size = {MMAP_SIZE_BYTES}")
+            self._local.connection = connection
+        return connection
+
+    def lookup(self, word: str) -> list[str]:
+        row = self._get_connection().execute("SELECT meanings FROM entries WHERE word = ?", (word,)).fetchone()
+        if row is None or not row[0]:
+            return []
+        return row[0].split(MEANING_SEPARATOR)
+
+    def lookup_many(self, words: Iterable[str]) -> dict[str, list[str]]:
+        """Looks up several words with as few queries as possible. Words without meanings are omitted."""
+        unique_words = list(dict.fromkeys(words))
+        results = {}
+        connection = self._get_connection()
+        for start in range(0, len(unique_words), MAX_LOOKUP_BATCH):
+            batch = unique_words[start:start + MAX_LOOKUP_BATCH]
+            placeholders = ",".join("?" * len(batch))
+            for word, meanings in connection.execute(
+                    f"SELECT word, meanings FROM entries WHERE word IN ({placeholders})", batch):
+                if meanings:
+                    results[word] = meanings.split(MEANING_SEPARATOR)
+        return results
+
+
+_dictionary_index = None  # type: Optional[DictionaryIndex]
+_dictionary_index_lock = threading.Lock()
+
+
+def get_dictionary_index() -> DictionaryIndex:
+    """Lazy initialization of the dictionary index, building it from jitendex.json if needed."""
+    global _dictionary_index
+    with _dictionary_index_lock:
+        if _dictionary_index is None:
+            if not os.path.exists(DEFAULT_INDEX_PATH):
+                if not os.path.exists(DEFAULT_JSON_PATH):
+                    raise FileNotFoundError(f"Neither {DEFAULT_INDEX_PATH} nor {DEFAULT_JSON_PATH} exist.")
+                build_dictionary_index(DEFAULT_JSON_PATH, DEFAULT_INDEX_PATH)
+            _dictionary_index = DictionaryIndex(DEFAULT_INDEX_PATH)
+    return _dictionary_index
+
+
+def set_dictionary_index(index_path: str):
+    """Uses the index at index_path instead of the default one."""
+    global _dictionary_index
+    with _dictionary_index_lock:
+        _dictionary_index = DictionaryIndex(index_path)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Build the dictionary index used by 'Define (without AI)'.")
+    parser.add_argument("--input", default=DEFAULT_JSON_PATH, help="The jitendex.json from scripts/mdict_to_json.py")
+    parser.add_argument("--output", default=DEFAULT_INDEX_PATH)
+    args = parser.parse_args()
+    build_dictionary_index(args.input, args.output)
@@ -1,19 +1,26 @@
-from fugashi import Tagger
-import json
-from typing import Optional
+from typing import NamedTuple, Optional, TYPE_CHECKING
 import re
 from dataclasses import dataclass
-from jamdict import Jamdict
-import os
-import lzma
-import shutil
-from pathlib import Path
+from functools import lru_cache
 import logging
+import sqlite3
+import threading
 
-_sentence_parser = None  # type: Optional[Tagger]
-_meaning_dict = {}   # type: dict[str, str]
-_jamdict: Optional[Jamdict] = None
+from library.dictionary_index import get_dictionary_index
+from library.reading_index import get_reading_index, get_reading_index_status
+
+# fugashi is imported on first use, so startup doesn't wait for it
+if TYPE_CHECKING:
+    from fugashi import Tagger
+
+_taggers = threading.local()
 USE_BASE_WORDS = False
+# sentences come back often (retries, history navigation, repeated lines), so their parses are kept around
+PARSE_CACHE_SIZE = 2048
+
+# katakana (ァ to ヶ) sit 0x60 code points after the matching hiragana; 'ー' and the like are kept as they are.
+# ヂ is read as じ, like the pronunciations fugashi gives.
+_KATAKANA_TO_HIRAGANA = str.maketrans({**{chr(c): chr(c - 0x60) for c in range(ord("ァ"), ord("ヶ") + 1)}, "ヂ": "じ"})
 
 
 @dataclass
@@ -23,14 +30,51 @@ class VocabEntry:
     meanings: list[str]
 
 
-def _initialize_fugashi():
-    global _sentence_parser, _meaning_dict
-    if _sentence_parser:
-        return
+class Morpheme(NamedTuple):
+    surface: str
+    pos1: str
+    pron: Optional[str]
+    pron_base: Optional[str]
+    lemma: Optional[str]
+
+
+def get_tagger() -> "Tagger":
+    """MeCab taggers aren't safe to share between threads, so each thread gets its own."""
+    tagger = getattr(_taggers, "tagger", None)
+    if tagger is None:
+        from fugashi import Tagger
+        tagger = Tagger('-Owakati')
+        _taggers.tagger = tagger
+    return tagger
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_morphemes(sentence: str) -> tuple[Morpheme, ...]:
+    morphemes = []
+    for word in get_tagger()(sentence):
+        feature = word.feature
+        morphemes.append(Morpheme(word.surface, feature.pos1, feature.pron, feature.pronBase, feature.lemma))
+    return tuple(morphemes)
+
+
+# skip particles (助詞) and aux verbs (助動詞)
+_SKIPPED_POS = frozenset(["助詞", "助動詞"])
+
 
-    _sentence_parser = Tagger('-Owakati')
-    with open(os.path.join("data", "jitendex.json"), "r", encoding="utf-8") as f:
-        _meaning_dict = json.load(f)
+def _parse_words(sentence: str) -> list[tuple[str, str]]:
+    """The (word, katakana reading) of each word worth defining in the sentence."""
+    words = []
+    for morpheme in parse_morphemes(sentence):
+        if morpheme.pos1 in _SKIPPED_POS:
+            continue
+        # skip punctuation
+        if morpheme.pron_base == "*":
+            continue
+        if USE_BASE_WORDS:
+            words.append((morpheme.lemma, morpheme.pron_base))
+        else:
+            words.append((morpheme.surface, morpheme.pron))
+    return words
 
 
 def get_definitions_for_sentence(sentence: str) -> list[VocabEntry]:
@@ -39,44 +83,35 @@ def get_definitions_for_sentence(sentence: str) -> list[VocabEntry]:
     :param sentence:
     :return:
     """
-    _initialize_fugashi()
-    _sentence_parser.parse(sentence)
+    return get_definitions_for_sentences([sentence])[0]
 
-    readings = []
-    for word in _sentence_parser(sentence):
-        # skip particles (助詞) and aux verbs (助動詞)
-        if word.feature.pos1 in ["助詞", "助動詞"]:
-            continue
-        # skip punctuation
-        if word.feature.pronBase in ["*"]:
-            continue
-        if USE_BASE_WORDS:
-            base_word = word.feature.lemma
-            base_word_reading = word.feature.pronBase
-        else:
-            base_word = str(word)
-            base_word_reading = word.feature.pron
-        meanings = _meaning_dict.get(base_word, {}).get("meanings", [])
-        readings.append(VocabEntry(
-                base_form=base_word,
-                readings=[hiragana_reading(base_word_reading)],
-                meanings=meanings,
-            ))
-    return readings
 
+def get_definitions_for_sentences(sentences: list[str]) -> list[list[VocabEntry]]:
+    """Same as get_definitions_for_sentence for each sentence, with a single dictionary lookup for all of them."""
+    words_per_sentence = [_parse_words(sentence) for sentence in sentences]
+    meanings_by_word = get_dictionary_index().lookup_many(
+        word for words in words_per_sentence for word, _ in words)
+    return [[VocabEntry(base_form=word, readings=[hiragana_reading(reading)], meanings=meanings_by_word.get(word, []))
+             for word, reading in words]
+            for words in words_per_sentence]
 
-def get_definitions_string(sentence: str):
-    text = ""
-    seen = []
-    for definition in get_definitions_for_sentence(sentence):
+
+def format_definitions(definitions: list[VocabEntry]) -> str:
+    lines = []
+    seen = set()
+    for definition in definitions:
         if definition.meanings:
             readings_str = ",".join(definition.readings)
-            new = f"- {definition.base_form} ({readings_str}) - {definition.meanings[0]}\n"
-            if new in seen:
+            line = f"- {definition.base_form} ({readings_str}) - {definition.meanings[0]}\n"
+            if line in seen:
                 continue
-            text += new
-            seen.append(new)
-    return f"Definitions:\n{text}"
+            lines.append(line)
+            seen.add(line)
+    return "Definitions:\n" + "".join(lines)
+
+
+def get_definitions_string(sentence: str):
+    return format_definitions(get_definitions_for_sentence(sentence))
 
 
 def parse_vocab_readings(text: str) -> list[VocabEntry]:
@@ -101,125 +136,35 @@ def parse_vocab_readings(text: str) -> list[VocabEntry]:
     return vocab_entries
 
 
-def get_jamdict() -> Jamdict:
-    """Lazy initialization of Jamdict with custom DB path."""
-    global _jamdict
-    if _jamdict is None:
-        db_path = ensure_jamdict_db()
-        logging.info(f"Loading JAMDICT")
-        _jamdict = Jamdict(db_path)
-        logging.info(f"Loaded JAMDICT")
-    return _jamdict
-
-
-def ensure_jamdict_db() -> str:
-    """
-    Ensures jamdict.db exists in the temp directory.
-    Returns the path to the database.
-    """
-    tmp_db_path = Path(os.path.join("tmp", "jamdict.db"))
-
-    if tmp_db_path.exists():
-        return str(tmp_db_path)
-
-    os.makedirs("tmp/", exist_ok=True)
-
-    logging.info(f"Extracting JAMDICT")
-    try:
-        with lzma.open(os.path.join("data", "jamdict.db.xz")) as compressed:
-            with open(tmp_db_path, 'wb') as uncompressed:
-                shutil.copyfileobj(compressed, uncompressed)
-    except Exception as e:
-        logging.info(f"Failed to extract JAMDICT")
-        raise RuntimeError(f"Failed to extract database: {e}")
-    logging.info(f"Extracted JAMDICT")
-
-    return str(tmp_db_path)
-
-
 def correct_vocab_readings(entries: list[VocabEntry]) -> list[VocabEntry]:
     """
     Takes a list of VocabEntry and returns an updated list with verified readings.
-    Preserves original entries if no readings found.
+    Preserves original entries if no readings found, or if the reading index isn't ready yet.
     """
-    jam = get_jamdict()
-    corrected_entries = []
+    reading_index = get_reading_index()
+    if reading_index is None:
+        logging.warning(f"JMDict readings aren't ready yet ({get_reading_index_status() or 'unavailable'}), "
+                        f"using the suggested readings")
+        return entries
 
+    try:
+        readings_by_word = reading_index.lookup_many(entry.base_form for entry in entries)
+    except sqlite3.Error as e:
+        logging.error(f"Error looking up readings: {e}")
+        return entries
     for entry in entries:
-        try:
-            result = jam.lookup(entry.base_form)
-            if result.entries:
-                new_readings = [str(kana) for kana in result.entries[0].kana_forms]
-                if new_readings:
-                    entry.readings = new_readings
-                else:
-                    logging.info(f"No readings found for: {entry.base_form}")
-            else:
-                logging.info(f"No JMDict entry found for: {entry.base_form}")
-        except Exception as e:
-            logging.error(f"Error looking up {entry.base_form}: {str(e)}")
-        corrected_entries.append(entry)
-    return corrected_entries
+        new_readings = readings_by_word.get(entry.base_form)
+        if new_readings:
+            entry.readings = new_readings
+        else:
+            logging.info(f"No JMDict entry found for: {entry.base_form}")
+    return entries
 
 
 def hiragana_reading(katakana_reading: str) -> str:
     if katakana_reading is None:
         return ""
-    katakana_to_hiragana = {
-        "ア": "あ",
-        "イ": "い",
-        "ウ": "う",
-        "エ": "え",
-        "オ": "お",
-        "カ": "か",
-        "キ": "き",
-        "ク": "く",
-        "ケ": "け",
-        "コ": "こ",
-        "サ": "さ",
-        "シ": "し",
-        "ス": "す",
-        "セ": "せ",
-        "ソ": "そ",
-        "タ": "た",
-        "チ": "ち",
-        "ツ": "つ",
-        "テ": "て",
-        "ト": "と",
-        "ナ": "な",
-        "ニ": "に",
-        "ヌ": "ぬ",
-        "ネ": "ね",
-        "ノ": "の",
-        "ハ": "は",
-        "ヒ": "ひ",
-        "フ": "ふ",
-        "ヘ": "へ",
-        "ホ": "ほ",
-        "マ": "ま",
-        "ミ": "み",
-        "ム": "む",
-        "メ": "め",
-        "モ": "も",
-        "ヤ": "や",
-        "ユ": "ゆ",
-        "ヨ": "よ",
-        "ラ": "ら",
-        "リ": "り",
-        "ル": "る",
-        "レ": "れ",
-        "ロ": "ろ",
-        "ワ": "わ",
-        "ヲ": "を",
-        "ン": "ん",
-        "ヂ": "じ",
-        "ヅ": "づ",
-        "ッ": "っ",
-        "ヰ": "ゐ",
-        "ヱ": "ゑ"
-    }
-    result = [katakana_to_hiragana.get(c, c) for c in katakana_reading]
-    return "".join(result)
+    return katakana_reading.translate(_KATAKANA_TO_HIRAGANA)
 
 
 if __name__ == "__main__":
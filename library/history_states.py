@@ -0,0 +1,163 @@
+"""
+The UI state of every sentence seen in a session (translation, definitions, Q&A and the history at that point), for
+going back and forth with the previous/next buttons.
+
+A session can go on for hours, so the states are kept small:
+- each history is a tuple of line ids into a table where each line is stored once, and a state whose history didn't
+  change shares the previous state's tuple;
+- only the most recent states stay in memory; older ones are spilled to a temporary file (with their history lines, so
+  the table can forget lines that only they used) and read back when they're navigated to.
+"""
+from array import array
+from typing import Optional
+import json
+import logging
+import tempfile
+
+
+class HistoryState:
+    __slots__ = ("ui_sentence", "ui_translation", "ui_translation_validation", "ui_definitions", "ui_question",
+                 "ui_response", "history_ids")
+
+    def __init__(self, sentence, translation, translation_validation, definitions, question, response,
+                 history_ids: tuple[int, ...]):
+        self.ui_sentence = sentence
+        self.ui_translation = translation
+        self.ui_translation_validation = translation_validation
+        self.ui_definitions = definitions
+        self.ui_question = question
+        self.ui_response = response
+        self.history_ids = history_ids
+
+    def to_record(self, history: list[str]) -> list:
+        return [self.ui_sentence, self.ui_translation, self.ui_translation_validation, self.ui_definitions,
+                self.ui_question, self.ui_response, history]
+
+
+class LineTable:
+    """Each distinct line once, with a stable id."""
+    def __init__(self):
+        self._lines = []  # type: list[str]
+        self._ids = {}  # type: dict[str, int]
+
+    def get_id(self, line: str) -> int:
+        line_id = self._ids.get(line)
+        if line_id is None:
+            line_id = len(self._lines)
+            self._lines.append(line)
+            self._ids[line] = line_id
+        return line_id
+
+    def __len__(self) -> int:
+        return len(self._lines)
+
+    def get_line(self, line_id: int) -> str:
+        return self._lines[line_id]
+
+
+class HistoryStates:
+    """
+    A list of HistoryState, where all but the last max_in_memory can live on disk.
+    The history_ids of a state are only valid until the next change to the list.
+    """
+    def __init__(self, max_in_memory: int = 100, spill_to_disk: bool = True):
+        self.max_in_memory = max(1, max_in_memory)
+        self.spill_to_disk = spill_to_disk
+        self._lines = LineTable()
+        self._lines_after_compaction = 0
+        self._last_history_ids = ()  # type: tuple[int, ...]
+        # None where the state was spilled; its offset and length in the spill file are at the same index
+        self._states = []  # type: list[Optional[HistoryState]]
+        self._spilled_offsets = array("q")
+        self._spilled_lengths = array("q")
+        self._spill_file = None
+        # every state before this one is on disk
+        self._first_in_memory = 0
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def __getitem__(self, index: int) -> HistoryState:
+        if index < 0:
+            index += len(self._states)
+        state = self._states[index]
+        if state is None:
+            state = self._read_spilled(index)
+        return state
+
+    def __setitem__(self, index: int, state: HistoryState):
+        if index < 0:
+            index += len(self._states)
+        self._states[index] = state
+        self._first_in_memory = min(self._first_in_memory, index)
+        self._spill_old_states()
+
+    def append(self, state: HistoryState):
+        self._states.append(state)
+        self._spilled_offsets.append(-1)
+        self._spilled_lengths.append(0)
+        self._spill_old_states()
+
+    def intern_history(self, history: list[str]) -> tuple[int, ...]:
+        history_ids = tuple(self._lines.get_id(line) for line in history)
+        # most sentences don't change the history, or do so in the same way; share the tuple when they're equal
+        if history_ids == self._last_history_ids:
+            return self._last_history_ids
+        self._last_history_ids = history_ids
+        return history_ids
+
+    def get_history(self, history_ids: tuple[int, ...]) -> list[str]:
+        return [self._lines.get_line(line_id) for line_id in history_ids]
+
+    def _spill_old_states(self):
+        if not self.spill_to_disk:
+            return
+        last_to_spill = len(self._states) - self.max_in_memory
+        for index in range(self._first_in_memory, last_to_spill):
+            state = self._states[index]
+            if state is not None:
+                try:
+                    self._write_spilled(index, state)
+                except OSError as e:
+                    logging.error(f"Failed to move history states to disk, keeping them in memory: {e}")
+                    self.spill_to_disk = False
+                    return
+                self._states[index] = None
+        self._first_in_memory = max(self._first_in_memory, last_to_spill)
+        # amortized: the table is rebuilt each time it doubles
+        if len(self._lines) > 2 * max(self._lines_after_compaction, 1000):
+            self._compact_lines()
+
+    def _compact_lines(self):
+        """Drops the lines that only the spilled states used, renumbering the others."""
+        old_lines = self._lines
+        self._lines = LineTable()
+        # keeps the tuples that were shared, shared
+        remapped = {}  # type: dict[tuple[int, ...], tuple[int, ...]]
+
+        def remap(history_ids: tuple[int, ...]) -> tuple[int, ...]:
+            if history_ids not in remapped:
+                remapped[history_ids] = tuple(self._lines.get_id(old_lines.get_line(i)) for i in history_ids)
+            return remapped[history_ids]
+
+        for state in self._states[self._first_in_memory:]:
+            if state is not None:
+                state.history_ids = remap(state.history_ids)
+        self._last_history_ids = remap(self._last_history_ids)
+        self._lines_after_compaction = len(self._lines)
+
+    def _write_spilled(self, index: int, state: HistoryState):
+        if self._spill_file is None:
+            # deleted as soon as it's closed, including when the app exits
+            self._spill_file = tempfile.TemporaryFile()
+        record = state.to_record(self.get_history(state.history_ids))
+        data = json.dumps(record, ensure_ascii=False).encode("utf-8")
+        # states that are saved again are appended; the old copy is never read again
+        self._spilled_offsets[index] = self._spill_file.seek(0, 2)
+        self._spilled_lengths[index] = len(data)
+        self._spill_file.write(data)
+
+    def _read_spilled(self, index: int) -> HistoryState:
+        self._spill_file.seek(self._spilled_offsets[index])
+        *fields, history = json.loads(self._spill_file.read(self._spilled_lengths[index]).decode("utf-8"))
+        return HistoryState(*fields, self.intern_history(history))
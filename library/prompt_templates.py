@@ -0,0 +1,99 @@
+from collections import OrderedDict
+from pathlib import Path
+from string import Template
+from threading import Lock
+from typing import Iterable, Optional
+import os
+
+# the number of distinct static prefixes kept per template (e.g. for different story contexts)
+STATIC_PREFIX_CACHE_SIZE = 8
+
+
+class PromptTemplate:
+    """
+    A prompt file, compiled once. Everything before the first per-request placeholder is the 'static prefix'; it's
+    rendered once per set of static values, so only the dynamic tail is substituted for each request.
+    """
+    def __init__(self, text: str):
+        self.text = text
+        self._lock = Lock()
+        self._tails = {}  # type: dict[frozenset[str], tuple[str, Template]]
+        self._static_prefixes = OrderedDict()  # type: OrderedDict[tuple, str]
+
+    def _split(self, dynamic_keys: Iterable[str]) -> tuple[str, Template]:
+        dynamic_keys = frozenset(dynamic_keys)
+        with self._lock:
+            if dynamic_keys not in self._tails:
+                split_at = len(self.text)
+                for match in Template.pattern.finditer(self.text):
+                    if (match.group("named") or match.group("braced")) in dynamic_keys:
+                        split_at = match.start()
+                        break
+                self._tails[dynamic_keys] = (self.text[:split_at], Template(self.text[split_at:]))
+            return self._tails[dynamic_keys]
+
+    def render_static_prefix(self, static_data: dict[str, str], dynamic_keys: Iterable[str]) -> str:
+        """The start of the prompt, which is identical for every request with the same static_data."""
+        prefix, _ = self._split(dynamic_keys)
+        cache_key = (prefix, tuple(sorted(static_data.items())))
+        with self._lock:
+            if cache_key in self._static_prefixes:
+                self._static_prefixes.move_to_end(cache_key)
+                return self._static_prefixes[cache_key]
+        rendered = Template(prefix).safe_substitute(static_data)
+        with self._lock:
+            self._static_prefixes[cache_key] = rendered
+            while len(self._static_prefixes) > STATIC_PREFIX_CACHE_SIZE:
+                self._static_prefixes.popitem(last=False)
+        return rendered
+
+    def render_parts(self, static_data: dict[str, str], dynamic_data: dict[str, str]) -> tuple[str, str]:
+        """Returns the static prefix and the dynamic tail; together, they're the full prompt."""
+        static_prefix = self.render_static_prefix(static_data, dynamic_data.keys())
+        _, tail = self._split(dynamic_data.keys())
+        return static_prefix, tail.safe_substitute({**static_data, **dynamic_data})
+
+    def render(self, static_data: dict[str, str], dynamic_data: dict[str, str]) -> str:
+        return "".join(self.render_parts(static_data, dynamic_data))
+
+
+class _CachedFile:
+    def __init__(self, mtime_ns: int, text: str):
+        self.mtime_ns = mtime_ns
+        self.text = text
+        self._template = None  # type: Optional[PromptTemplate]
+
+    @property
+    def template(self) -> PromptTemplate:
+        if self._template is None:
+            self._template = PromptTemplate(self.text)
+        return self._template
+
+
+_cached_files = {}  # type: dict[str, _CachedFile]
+_cached_files_lock = Lock()
+
+
+def _get_cached_file(filepath: str) -> _CachedFile:
+    # a stat per call is cheap compared to reading the file; editing the file invalidates the cached copy
+    try:
+        mtime_ns = os.stat(filepath).st_mtime_ns
+    except FileNotFoundError:
+        raise FileNotFoundError(f"File not found: {filepath}")
+    with _cached_files_lock:
+        cached = _cached_files.get(filepath)
+        if cached is not None and cached.mtime_ns == mtime_ns:
+            return cached
+    text = Path(filepath).read_text(encoding='utf-8')
+    cached = _CachedFile(mtime_ns, text)
+    with _cached_files_lock:
+        _cached_files[filepath] = cached
+    return cached
+
+
+def read_cached_file(filepath: str) -> str:
+    return _get_cached_file(filepath).text
+
+
+def get_prompt_template(filepath: str) -> PromptTemplate:
+    return _get_cached_file(filepath).template
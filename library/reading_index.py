@@ -0,0 +1,136 @@
+"""
+reading_index maps each JMDict surface form (kanji or kana) to the kana readings of its first entry, for
+Define->Analysis. It's built from jamdict.db into the same compact SQLite format as dictionary_index, so a whole
+vocabulary list is resolved in one query instead of a jamdict lookup per word.
+
+Build it ahead of time with:
+    python -m library.reading_index
+Otherwise, start_reading_index_build() extracts jamdict.db and builds it on a background thread, and lookups skip the
+corrections until it's ready.
+"""
+from threading import Lock, Thread
+from typing import Callable, Optional
+import argparse
+import logging
+import lzma
+import os
+import sqlite3
+
+from library.dictionary_index import DictionaryIndex, write_index
+
+DEFAULT_ARCHIVE_PATH = os.path.join("data", "jamdict.db.xz")
+DEFAULT_JAMDICT_PATH = os.path.join("tmp", "jamdict.db")
+DEFAULT_READING_INDEX_PATH = os.path.join("data", "jmdict_readings.db")
+EXTRACT_CHUNK_BYTES = 4 * 1024 * 1024
+
+
+def extract_jamdict(archive_path: str = DEFAULT_ARCHIVE_PATH, db_path: str = DEFAULT_JAMDICT_PATH,
+                    progress: Optional[Callable[[float], None]] = None):
+    """Decompresses jamdict.db.xz, reporting the fraction of the archive read so far."""
+    logging.info(f"Extracting {archive_path}")
+    archive_size = os.path.getsize(archive_path)
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    tmp_path = db_path + ".tmp"
+    with open(archive_path, "rb") as archive, lzma.open(archive) as compressed, open(tmp_path, "wb") as uncompressed:
+        while chunk := compressed.read(EXTRACT_CHUNK_BYTES):
+            uncompressed.write(chunk)
+            if progress:
+                progress(archive.tell() / archive_size)
+    # only a complete database ever has the final name
+    os.replace(tmp_path, db_path)
+    logging.info(f"Extracted {db_path}")
+
+
+def build_reading_index(jamdict_path: str = DEFAULT_JAMDICT_PATH, index_path: str = DEFAULT_READING_INDEX_PATH):
+    logging.info(f"Building reading index {index_path} from {jamdict_path}")
+    connection = sqlite3.connect(f"file:{os.path.abspath(jamdict_path)}?mode=ro", uri=True)
+    try:
+        readings_by_entry = {}
+        for idseq, text in connection.execute("SELECT idseq, text FROM Kana ORDER BY ID"):
+            readings_by_entry.setdefault(idseq, []).append(text)
+        # jamdict's lookup returns entries in Entry order, and the first one's readings were used
+        readings_by_word = {}
+        for word, idseq in connection.execute(
+                "SELECT form.text, Entry.idseq FROM (SELECT idseq, text FROM Kanji UNION ALL "
+                "SELECT idseq, text FROM Kana) AS form JOIN Entry ON Entry.idseq = form.idseq ORDER BY Entry.rowid"):
+            if word not in readings_by_word and idseq in readings_by_entry:
+                readings_by_word[word] = readings_by_entry[idseq]
+    finally:
+        connection.close()
+    write_index(readings_by_word.items(), index_path)
+    logging.info(f"Built reading index with {len(readings_by_word)} words")
+
+
+class ReadingIndexBuild:
+    """Prepares the reading index on a background thread; status is a short description for the UI."""
+    def __init__(self, index_path: str, archive_path: str, jamdict_path: str):
+        self.index_path = index_path
+        self.archive_path = archive_path
+        self.jamdict_path = jamdict_path
+        self.status = ""
+        self.failed = False
+        self._thread = Thread(target=self._build)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def _set_extract_progress(self, fraction: float):
+        self.status = f"Extracting JMDict {fraction:.0%}"
+
+    def _build(self):
+        try:
+            if not os.path.exists(self.jamdict_path):
+                self._set_extract_progress(0)
+                extract_jamdict(self.archive_path, self.jamdict_path, self._set_extract_progress)
+            self.status = "Indexing JMDict"
+            build_reading_index(self.jamdict_path, self.index_path)
+            self.status = ""
+        except Exception as e:
+            logging.error(f"Failed to build the JMDict reading index: {e}")
+            self.status = "JMDict unavailable"
+            self.failed = True
+
+
+_reading_index = None  # type: Optional[DictionaryIndex]
+_reading_index_build = None  # type: Optional[ReadingIndexBuild]
+_reading_index_lock = Lock()
+
+
+def start_reading_index_build():
+    """Starts preparing the reading index in the background, unless it's already there or in progress."""
+    global _reading_index_build
+    with _reading_index_lock:
+        if _reading_index_build is None and not os.path.exists(DEFAULT_READING_INDEX_PATH):
+            _reading_index_build = ReadingIndexBuild(DEFAULT_READING_INDEX_PATH, DEFAULT_ARCHIVE_PATH,
+                                                     DEFAULT_JAMDICT_PATH)
+            _reading_index_build.start()
+
+
+def get_reading_index() -> Optional[DictionaryIndex]:
+    """The reading index, or None while it's still being prepared. Never blocks on the build."""
+    global _reading_index
+    start_reading_index_build()
+    with _reading_index_lock:
+        if _reading_index is None and os.path.exists(DEFAULT_READING_INDEX_PATH):
+            _reading_index = DictionaryIndex(DEFAULT_READING_INDEX_PATH)
+        return _reading_index
+
+
+def get_reading_index_status() -> str:
+    """What the background build is doing, or "" when there's nothing to report."""
+    build = _reading_index_build
+    return build.status if build is not None else ""
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Build the JMDict reading index used by Define->Analysis.")
+    parser.add_argument("--archive", default=DEFAULT_ARCHIVE_PATH, help="Extracted first if --jamdict doesn't exist.")
+    parser.add_argument("--jamdict", default=DEFAULT_JAMDICT_PATH)
+    parser.add_argument("--output", default=DEFAULT_READING_INDEX_PATH)
+    args = parser.parse_args()
+    if not os.path.exists(args.jamdict):
+        extract_jamdict(args.archive, args.jamdict, lambda fraction: print(f"\rExtracting {fraction:.0%}", end=""))
+        print()
+    build_reading_index(args.jamdict, args.output)
@@ -0,0 +1,186 @@
+"""
+Timing for each AI request: how long its command waited in the queue, the time to the first token, tokens per second
+and how it ended. Each request is appended as a JSON line to a rolling metrics file, and the latest one is summarized
+for the UI.
+
+The command that a request belongs to is tracked per thread: set_command_context is called before running a command,
+and any request streamed on that thread is attributed to it.
+"""
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+from threading import Lock, local
+from typing import Iterator, Optional
+import json
+import logging
+import os
+import time
+
+from library.settings_manager import settings
+from library.token_count import get_token_count
+
+OUTCOME_COMPLETED = "completed"
+OUTCOME_INTERRUPTED = "interrupted"
+OUTCOME_LOOP_BREAK = "loop-break"
+OUTCOME_STOPPED = "stopped"  # the caller stopped reading early, for another reason than a loop
+OUTCOME_ERROR = "error"
+
+_context = local()
+
+_metrics_logger = None  # type: Optional[logging.Logger]
+_metrics_logger_lock = Lock()
+
+_latest_summary = ""
+
+
+class RequestMetrics:
+    def __init__(self, backend: str, prompt_token_count: Optional[int]):
+        self.backend = backend
+        self.prompt_token_count = prompt_token_count
+        self.command_type = getattr(_context, "command_type", None)
+        self.enqueue_time = getattr(_context, "enqueue_time", None)
+        self.command_start_time = getattr(_context, "start_time", None)
+        self.prompt_template = getattr(_context, "prompt_template", None)
+        self.start_time = time.time()
+        self.first_token_time = None  # type: Optional[float]
+        self.last_token_time = None  # type: Optional[float]
+        self.token_count = 0
+        self.outcome = OUTCOME_ERROR
+
+    def to_record(self) -> dict:
+        def elapsed(start: Optional[float], end: Optional[float]) -> Optional[float]:
+            if start is None or end is None:
+                return None
+            return round(end - start, 3)
+
+        generation_seconds = elapsed(self.first_token_time, self.last_token_time)
+        tokens_per_second = None
+        if generation_seconds and self.token_count > 1:
+            # the first token marks the start of generation, so it isn't counted
+            tokens_per_second = round((self.token_count - 1) / generation_seconds, 2)
+        return {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.start_time)),
+            "command": self.command_type,
+            "prompt_template": self.prompt_template,
+            "backend": self.backend,
+            "outcome": self.outcome,
+            "queue_wait_seconds": elapsed(self.enqueue_time, self.command_start_time),
+            "time_to_first_token_seconds": elapsed(self.start_time, self.first_token_time),
+            "total_seconds": elapsed(self.start_time, self.last_token_time or time.time()),
+            "tokens_per_second": tokens_per_second,
+            "token_count": self.token_count,
+            "prompt_token_count": self.prompt_token_count,
+        }
+
+
+@contextmanager
+def command_context(command_type: str, enqueue_time: Optional[float]):
+    """Attributes the requests made on this thread (within the block) to a command."""
+    _context.command_type = command_type
+    _context.enqueue_time = enqueue_time
+    _context.start_time = time.time()
+    _context.prompt_template = None
+    try:
+        yield
+    finally:
+        _context.command_type = None
+        _context.enqueue_time = None
+        _context.start_time = None
+        _context.prompt_template = None
+
+
+def set_prompt_template(prompt_template: str):
+    _context.prompt_template = prompt_template
+
+
+def mark_loop_break():
+    """Called before abandoning a request because its response was looping."""
+    metrics = getattr(_context, "request", None)  # type: Optional[RequestMetrics]
+    if metrics is not None:
+        metrics.outcome = OUTCOME_LOOP_BREAK
+
+
+def track_request(tokens: Iterator[str], backend: str, prompt: str, prompt_token_count: Optional[int],
+                  cancel_token) -> Iterator[str]:
+    """
+    Passes the tokens through, timing them; the metrics are written once the stream ends.
+    If prompt_token_count isn't known (e.g. no context_length is set), the prompt is counted then, off the TTFT path.
+    """
+    if not settings.get_setting_fallback('request_metrics.enabled', True):
+        yield from tokens
+        return
+    metrics = RequestMetrics(backend, prompt_token_count)
+    previous_request = getattr(_context, "request", None)
+    _context.request = metrics
+    try:
+        for token in tokens:
+            metrics.last_token_time = time.time()
+            if metrics.first_token_time is None:
+                metrics.first_token_time = metrics.last_token_time
+            metrics.token_count += 1
+            yield token
+        metrics.outcome = OUTCOME_INTERRUPTED if cancel_token.is_cancelled else OUTCOME_COMPLETED
+    except GeneratorExit:
+        if cancel_token.is_cancelled:
+            metrics.outcome = OUTCOME_INTERRUPTED
+        elif metrics.outcome != OUTCOME_LOOP_BREAK:
+            metrics.outcome = OUTCOME_STOPPED
+        raise
+    finally:
+        tokens.close()
+        _context.request = previous_request
+        if metrics.prompt_token_count is None:
+            metrics.prompt_token_count = _count_prompt_tokens(prompt)
+        _write_metrics(metrics)
+
+
+def _count_prompt_tokens(prompt: str) -> Optional[int]:
+    try:
+        # every prompt is different, so it's not worth caching
+        return get_token_count(prompt, cache=False)
+    except Exception as e:
+        logging.error(f"Failed to count prompt tokens: {e}")
+        return None
+
+
+def _get_metrics_logger() -> logging.Logger:
+    global _metrics_logger
+    with _metrics_logger_lock:
+        if _metrics_logger is None:
+            filepath = settings.get_setting_fallback('request_metrics.filepath', "metrics/request_metrics.jsonl")
+            os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+            max_bytes = int(settings.get_setting_fallback('request_metrics.max_size_mb', 8) * 1024 * 1024)
+            handler = RotatingFileHandler(filepath, maxBytes=max_bytes, backupCount=2, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            _metrics_logger = logging.getLogger("request_metrics")
+            _metrics_logger.setLevel(logging.INFO)
+            _metrics_logger.propagate = False
+            _metrics_logger.addHandler(handler)
+        return _metrics_logger
+
+
+def _write_metrics(metrics: RequestMetrics):
+    global _latest_summary
+    record = metrics.to_record()
+    try:
+        _get_metrics_logger().info(json.dumps(record, ensure_ascii=False))
+    except OSError as e:
+        logging.error(f"Failed to write request metrics: {e}")
+    _latest_summary = summarize(record)
+
+
+def summarize(record: dict) -> str:
+    parts = [record["backend"]]
+    if record["time_to_first_token_seconds"] is not None:
+        parts.append(f"TTFT {record['time_to_first_token_seconds']:.2f}s")
+    if record["tokens_per_second"] is not None:
+        parts.append(f"{record['tokens_per_second']:.1f} tok/s")
+    if record["queue_wait_seconds"] is not None:
+        parts.append(f"wait {record['queue_wait_seconds']:.2f}s")
+    if record["outcome"] != OUTCOME_COMPLETED:
+        parts.append(record["outcome"])
+    return " · ".join(parts)
+
+
+def get_latest_summary() -> str:
+    """A one line summary of the most recent request, for the status readout."""
+    return _latest_summary
@@ -0,0 +1,155 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from threading import Lock
+from typing import Iterator, Optional
+
+from library.ai_requests import run_ai_request_stream, get_api_choice, get_model_identifier, CancellationToken
+from library.settings_manager import settings
+
+DEFAULT_NAMESPACE = "default"
+
+
+class ResponseCache:
+    """
+    An on-disk cache of completed AI responses, keyed by everything that determines the request.
+    Entries are namespaced per story, and the least recently used entries are evicted once the cache is too large.
+    """
+    def __init__(self, db_path: str, max_size_bytes: int):
+        self.db_path = db_path
+        self.max_size_bytes = max_size_bytes
+        self._lock = Lock()
+        self._connection = None  # type: Optional[sqlite3.Connection]
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            self._connection = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    tokens TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                )""")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+            self._connection.commit()
+        return self._connection
+
+    def get(self, namespace: str, key: str) -> Optional[list[str]]:
+        with self._lock:
+            connection = self._get_connection()
+            row = connection.execute("SELECT tokens FROM responses WHERE namespace = ? AND key = ?",
+                                     (namespace, key)).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE responses SET last_used = ? WHERE namespace = ? AND key = ?",
+                               (time.time(), namespace, key))
+            connection.commit()
+        return json.loads(row[0])
+
+    def put(self, namespace: str, key: str, tokens: list[str]):
+        serialized = json.dumps(tokens, ensure_ascii=False)
+        size = len(serialized.encode("utf-8"))
+        if size > self.max_size_bytes:
+            return
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute("INSERT OR REPLACE INTO responses (namespace, key, tokens, size, last_used) "
+                               "VALUES (?, ?, ?, ?, ?)", (namespace, key, serialized, size, time.time()))
+            self._evict(connection)
+            connection.commit()
+
+    def _evict(self, connection: sqlite3.Connection):
+        total_size = connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total_size <= self.max_size_bytes:
+            return
+        evicted = 0
+        rows = connection.execute("SELECT namespace, key, size FROM responses ORDER BY last_used ASC").fetchall()
+        for namespace, key, size in rows:
+            if total_size <= self.max_size_bytes:
+                break
+            connection.execute("DELETE FROM responses WHERE namespace = ? AND key = ?", (namespace, key))
+            total_size -= size
+            evicted += 1
+        logging.info(f"Evicted {evicted} entries from the response cache.")
+
+
+_response_cache = None  # type: Optional[ResponseCache]
+_response_cache_lock = Lock()
+_namespace = DEFAULT_NAMESPACE
+
+
+def set_namespace(namespace: Optional[str]):
+    """Responses are only replayed within the same namespace (e.g. the story name)."""
+    global _namespace
+    _namespace = namespace or DEFAULT_NAMESPACE
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    global _response_cache
+    if not settings.get_setting_fallback('response_cache.enabled', False):
+        return None
+    with _response_cache_lock:
+        if _response_cache is None:
+            db_path = settings.get_setting_fallback('response_cache.db_filepath',
+                                                    os.path.join("cache", "responses.db"))
+            max_size_mb = settings.get_setting_fallback('response_cache.max_size_mb', 64)
+            _response_cache = ResponseCache(db_path, int(max_size_mb * 1024 * 1024))
+    return _response_cache
+
+
+def make_cache_key(prompt: str, custom_stopping_strings: Optional[list[str]], temperature: float,
+                   max_response: int, ban_eos_token: bool, api_override: Optional[str]) -> str:
+    api_choice = get_api_choice(api_override)
+    key_data = {
+        "prompt": prompt,
+        "api": api_choice,
+        "model": get_model_identifier(api_choice),
+        "temperature": temperature,
+        "stop": custom_stopping_strings or [],
+        "max_response": max_response,
+        "ban_eos_token": ban_eos_token,
+    }
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def run_cached_ai_request_stream(prompt: str, custom_stopping_strings: Optional[list[str]] = None,
+                                 temperature: float = .1, max_response: int = 2048, ban_eos_token: bool = True,
+                                 print_prompt=True, api_override: Optional[str] = None,
+                                 cancel_token: Optional[CancellationToken] = None,
+                                 prompt_token_count: Optional[int] = None, refresh: bool = False) -> Iterator[str]:
+    """
+    Drop-in replacement for run_ai_request_stream that replays the stored tokens of an identical earlier request.
+    Only responses that were streamed to completion are stored; interrupted generations are never cached.
+    With refresh (e.g. for Retry), the stored response is ignored and replaced by the new one.
+    """
+    cache = get_response_cache()
+    if cache is None:
+        yield from run_ai_request_stream(prompt, custom_stopping_strings, temperature, max_response, ban_eos_token,
+                                         print_prompt, api_override=api_override, cancel_token=cancel_token,
+                                         prompt_token_count=prompt_token_count)
+        return
+
+    namespace = _namespace
+    key = make_cache_key(prompt, custom_stopping_strings, temperature, max_response, ban_eos_token, api_override)
+    cached_tokens = None if refresh else cache.get(namespace, key)
+    if cached_tokens is not None:
+        logging.info(f"Replaying {len(cached_tokens)} cached tokens.")
+        yield from cached_tokens
+        return
+
+    tokens = []
+    for tok in run_ai_request_stream(prompt, custom_stopping_strings, temperature, max_response, ban_eos_token,
+                                     print_prompt, api_override=api_override, cancel_token=cancel_token,
+                                     prompt_token_count=prompt_token_count):
+        tokens.append(tok)
+        yield tok
+    # only reached if the caller consumed the whole stream (i.e. no interrupt or loop detection)
+    if tokens and not (cancel_token is not None and cancel_token.is_cancelled):
+        cache.put(namespace, key, tokens)
@@ -0,0 +1,188 @@
+"""
+Records every AI response (one JSON record per request) for debugging prompts and models.
+
+Tokens are collected in memory while a response streams, and the finished record is written by a background thread,
+so recording adds no file I/O per token and concurrent requests never share a file handle.
+"""
+from queue import SimpleQueue
+from threading import Lock, Thread
+from typing import AsyncIterator, Iterator, Optional, TYPE_CHECKING
+import asyncio
+import atexit
+import datetime
+import gzip
+import itertools
+import json
+import logging
+import os
+import time
+
+from library.settings_manager import settings
+
+if TYPE_CHECKING:
+    from library.ai_requests import CancellationToken
+
+OUTCOME_COMPLETED = "completed"
+OUTCOME_CANCELLED = "cancelled"
+OUTCOME_STOPPED = "stopped"  # the caller stopped reading, e.g. because the response was looping
+OUTCOME_ERROR = "error"
+
+_request_counter = itertools.count()
+
+
+def new_request_id() -> str:
+    return f"{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}-{next(_request_counter):06d}"
+
+
+class ResponseRecording:
+    def __init__(self, recorder: "ResponseRecorder", api_choice: str, prompt: Optional[str]):
+        self.recorder = recorder
+        self.request_id = new_request_id()
+        self.api_choice = api_choice
+        self.prompt = prompt
+        self.start_time = time.time()
+        self.tokens = []  # type: list[str]
+
+    def add(self, token: str):
+        self.tokens.append(token)
+
+    def finish(self, outcome: str):
+        record = {
+            "request_id": self.request_id,
+            "time": datetime.datetime.fromtimestamp(self.start_time).isoformat(timespec="seconds"),
+            "duration_seconds": round(time.time() - self.start_time, 3),
+            "api": self.api_choice,
+            "outcome": outcome,
+            "response": "".join(self.tokens),
+        }
+        if self.prompt is not None:
+            record["prompt"] = self.prompt
+        self.recorder.write(record)
+
+
+class ResponseRecorder:
+    """Appends records to a file per day in folder, optionally gzipped; all writes happen on one thread."""
+    def __init__(self, folder: str, compress: bool, include_prompt: bool):
+        self.folder = folder
+        self.compress = compress
+        self.include_prompt = include_prompt
+        self._records = SimpleQueue()
+        self._thread = Thread(target=self._writer_thread)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def start(self, api_choice: str, prompt: str) -> ResponseRecording:
+        return ResponseRecording(self, api_choice, prompt if self.include_prompt else None)
+
+    def write(self, record: dict):
+        self._records.put(record)
+
+    def close(self):
+        """Writes out the pending records."""
+        self._records.put(None)
+        self._thread.join(timeout=5)
+
+    def _get_path(self) -> str:
+        filename = datetime.datetime.now().strftime("%Y-%m-%d") + ".jsonl"
+        if self.compress:
+            filename += ".gz"
+        return os.path.join(self.folder, filename)
+
+    def _writer_thread(self):
+        os.makedirs(self.folder, exist_ok=True)
+        while True:
+            record = self._records.get()
+            if record is None:
+                return
+            # write everything that's queued up in one go
+            records = [record]
+            while not self._records.empty():
+                record = self._records.get()
+                if record is None:
+                    break
+                records.append(record)
+            lines = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records)
+            try:
+                # appending to a gzip file adds a new member; gzip.open reads them back as one stream
+                if self.compress:
+                    with gzip.open(self._get_path(), "at", encoding="utf-8") as f:
+                        f.write(lines)
+                else:
+                    with open(self._get_path(), "a", encoding="utf-8") as f:
+                        f.write(lines)
+            except OSError as e:
+                logging.error(f"Failed to record responses: {e}")
+            if record is None:
+                return
+
+
+_response_recorder = None  # type: Optional[ResponseRecorder]
+_response_recorder_lock = Lock()
+
+
+def get_response_recorder() -> Optional[ResponseRecorder]:
+    """None if response_recording.enabled is off."""
+    global _response_recorder
+    if not settings.get_setting_fallback('response_recording.enabled', False):
+        return None
+    with _response_recorder_lock:
+        if _response_recorder is None:
+            _response_recorder = ResponseRecorder(
+                settings.get_setting_fallback('response_recording.folder', "responses"),
+                settings.get_setting_fallback('response_recording.compress', False),
+                settings.get_setting_fallback('response_recording.include_prompt', False))
+            atexit.register(_response_recorder.close)
+        return _response_recorder
+
+
+def start_response_recording(api_choice: str, prompt: str) -> Optional[ResponseRecording]:
+    recorder = get_response_recorder()
+    if recorder is None:
+        return None
+    return recorder.start(api_choice, prompt)
+
+
+def _get_outcome(cancel_token: "CancellationToken", stopped: bool) -> str:
+    if cancel_token.is_cancelled:
+        return OUTCOME_CANCELLED
+    return OUTCOME_STOPPED if stopped else OUTCOME_COMPLETED
+
+
+def record_response(tokens: Iterator[str], api_choice: str, prompt: str,
+                    cancel_token: "CancellationToken") -> Iterator[str]:
+    """Passes the tokens through, and records the response once the stream ends."""
+    recording = start_response_recording(api_choice, prompt)
+    if recording is None:
+        yield from tokens
+        return
+    outcome = OUTCOME_ERROR
+    try:
+        for token in tokens:
+            recording.add(token)
+            yield token
+        outcome = _get_outcome(cancel_token, stopped=False)
+    except GeneratorExit:
+        outcome = _get_outcome(cancel_token, stopped=True)
+        raise
+    finally:
+        tokens.close()
+        recording.finish(outcome)
+
+
+async def record_response_async(tokens: AsyncIterator[str], api_choice: str, prompt: str,
+                                cancel_token: "CancellationToken") -> AsyncIterator[str]:
+    recording = start_response_recording(api_choice, prompt)
+    outcome = OUTCOME_ERROR
+    try:
+        async for token in tokens:
+            if recording is not None:
+                recording.add(token)
+            yield token
+        outcome = _get_outcome(cancel_token, stopped=False)
+    except (GeneratorExit, asyncio.CancelledError):
+        outcome = _get_outcome(cancel_token, stopped=True)
+        raise
+    finally:
+        await tokens.aclose()
+        if recording is not None:
+            recording.finish(outcome)
@@ -0,0 +1,24 @@
+"""
+Reading scripts (the lines of a game or a novel) for the batch commands and the prefetcher.
+"""
+import json
+
+JSONL_TEXT_KEYS = ["text", "sentence"]
+
+
+def read_script(script_path: str) -> list[str]:
+    """A text file with one line per sentence, or a JSONL file with a 'text' (or 'sentence') per line."""
+    lines = []
+    with open(script_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            if script_path.endswith(".jsonl"):
+                record = json.loads(line)
+                if isinstance(record, str):
+                    line = record
+                else:
+                    line = next((record[key] for key in JSONL_TEXT_KEYS if key in record), "")
+            if line.strip():
+                lines.append(line.strip())
+    return lines
@@ -0,0 +1,135 @@
+from queue import Queue, Full
+from threading import Lock, Thread
+from typing import Callable, Optional
+import logging
+
+from library.ai_requests import CancellationToken
+from library.context_packer import get_history_start
+from library.script_files import read_script
+
+# how far ahead of the current position a copied line is looked for before searching the whole script
+NEARBY_SEARCH_WINDOW = 50
+
+# (history, sentence, cancel_token) -> translation
+TranslateFunction = Callable[[list[str], str, CancellationToken], Optional[str]]
+# called with the translation, or None if it failed
+TranslationCallback = Callable[[Optional[str]], None]
+
+
+class ScriptPrefetcher:
+    """
+    Follows the reader's position in a script file by matching copied lines against it, and translates the next
+    few lines in the background so that their translations are ready before they're copied.
+    """
+    def __init__(self, script_path: str, translate: TranslateFunction, prefetch_lines: int, history_length: int):
+        self.lines = read_script(script_path)
+        self.translate = translate
+        self.prefetch_lines = prefetch_lines
+        self.history_length = history_length
+
+        self.position = -1
+        self._line_indices = {}  # type: dict[str, list[int]]
+        for index, line in enumerate(self.lines):
+            self._line_indices.setdefault(line, []).append(index)
+
+        self._lock = Lock()
+        self._translations = {}  # type: dict[int, str]
+        self._pending = set()  # type: set[int]
+        # the line being translated right now, and who's waiting for it
+        self._in_flight = None  # type: Optional[int]
+        self._waiters = []  # type: list[TranslationCallback]
+        self._queue = Queue(maxsize=max(1, prefetch_lines))  # type: Queue[int]
+        self._cancel_token = CancellationToken()
+
+        thread = Thread(target=self._prefetch_thread)
+        thread.daemon = True
+        thread.start()
+        logging.info(f"Loaded script with {len(self.lines)} lines from {script_path}")
+
+    def find_line(self, sentence: str) -> Optional[int]:
+        indices = self._line_indices.get(sentence.strip())
+        if not indices:
+            return None
+        # prefer the closest occurrence from the current position on, since repeated lines are common
+        for index in indices:
+            if self.position <= index <= self.position + NEARBY_SEARCH_WINDOW:
+                return index
+        return indices[0]
+
+    def advance_to(self, sentence: str) -> bool:
+        """Moves to the line matching the sentence (if any), and starts prefetching the lines after it."""
+        index = self.find_line(sentence)
+        if index is None:
+            return False
+        with self._lock:
+            self.position = index
+            upcoming = range(index + 1, min(len(self.lines), index + 1 + self.prefetch_lines))
+            # forget translations that are no longer needed
+            self._translations = {i: t for i, t in self._translations.items() if i in upcoming or i == index}
+            to_queue = [i for i in upcoming if i not in self._translations and i not in self._pending]
+            for i in to_queue:
+                try:
+                    self._queue.put_nowait(i)
+                    self._pending.add(i)
+                except Full:
+                    break
+        return True
+
+    def get_translation(self, sentence: str) -> Optional[str]:
+        index = self.find_line(sentence)
+        if index is None:
+            return None
+        with self._lock:
+            return self._translations.get(index)
+
+    def wait_for_translation(self, sentence: str, callback: TranslationCallback) -> bool:
+        """
+        If the sentence's line is being translated right now, calls callback (on the prefetch thread) once it's done
+        and returns True. Asking for it again would only queue up behind the prefetch on the same backend.
+        """
+        index = self.find_line(sentence)
+        if index is None:
+            return False
+        with self._lock:
+            translation = self._translations.get(index)
+            if translation is None:
+                if self._in_flight != index:
+                    return False
+                self._waiters.append(callback)
+                return True
+        # it finished in the meantime
+        callback(translation)
+        return True
+
+    def stop(self):
+        self._cancel_token.cancel()
+
+    def _prefetch_thread(self):
+        while not self._cancel_token.is_cancelled:
+            index = self._queue.get(block=True)
+            result = None
+            try:
+                with self._lock:
+                    is_upcoming = self.position < index <= self.position + self.prefetch_lines
+                    if is_upcoming:
+                        self._in_flight = index
+                if not is_upcoming:
+                    continue
+                history = self.lines[get_history_start(index, self.history_length):index]
+                translation = self.translate(history, self.lines[index], self._cancel_token)
+                if translation and not self._cancel_token.is_cancelled:
+                    result = translation.strip()
+                    with self._lock:
+                        self._translations[index] = result
+            except Exception as e:
+                logging.error(f"Exception while prefetching line {index}: {e}")
+            finally:
+                with self._lock:
+                    self._pending.discard(index)
+                    self._in_flight = None
+                    waiters, self._waiters = self._waiters, []
+                for callback in waiters:
+                    try:
+                        callback(result)
+                    except Exception as e:
+                        logging.error(f"Exception while handing over the prefetched line {index}: {e}")
@@ -1,6 +1,5 @@
 import tomli
 import os
-import json
 from typing import Any, Optional
 import logging
 
@@ -15,6 +14,8 @@ class SettingsManager:
         self._default_settings = {}
         self._user_settings = {}
         self._override_settings = None  # type: Optional[dict]
+        # every dotted key (sections included) -> (value, source), from the highest priority settings that have it
+        self._flattened_settings = {}  # type: dict[str, tuple[Any, str]]
 
     def load_settings(self, defaults_file_path: str, user_file_path: Optional[str]):
         with open(defaults_file_path, "rb") as f:
@@ -23,30 +24,34 @@ class SettingsManager:
         if user_file_path and os.path.exists(user_file_path):
             with open(user_file_path, "rb") as f:
                 self._user_settings = tomli.load(f)
+        self._rebuild_flattened_settings()
 
     def override_settings(self, file_path):
         with open(file_path, "rb") as f:
-            self._override_settings = tomli.load(f)
+            self.override_settings_from_dict(tomli.load(f))
+
+    def override_settings_from_dict(self, override_settings: dict):
+        """Same as override_settings, with the settings as a (nested) dict instead of a toml file."""
+        self._override_settings = override_settings
+        self._rebuild_flattened_settings()
 
     def remove_override_settings(self):
         self._override_settings = None
+        self._rebuild_flattened_settings()
 
-    def _get_setting(self, setting_name: str) -> Any:
+    def _rebuild_flattened_settings(self):
+        flattened = {}
+        _flatten_into(flattened, self._default_settings, "default")
+        _flatten_into(flattened, self._user_settings, "user")
         if self._override_settings is not None:
-            try:
-                result = search_nested_dict(self._override_settings, setting_name)
-                return result, "override"
-            except ValueError:
-                pass
-
-        try:
-            result = search_nested_dict(self._user_settings, setting_name), "user"
-        except ValueError:
-            try:
-                result = search_nested_dict(self._default_settings, setting_name), "default"
-            except ValueError as e:
-                logging.error(f"setting {setting_name} not found in override, user or default settings tomls")
-                raise e
+            _flatten_into(flattened, self._override_settings, "override")
+        self._flattened_settings = flattened
+
+    def _get_setting(self, setting_name: str) -> Any:
+        result = self._flattened_settings.get(setting_name)
+        if result is None:
+            logging.error(f"setting {setting_name} not found in override, user or default settings tomls")
+            raise ValueError(f"setting {setting_name} not found in override, user or default settings tomls")
         return result
 
     def get_setting(self, setting_name: str) -> Any:
@@ -55,21 +60,19 @@ class SettingsManager:
         return setting
 
     def get_setting_fallback(self, setting_name: str, fallback: Any) -> Any:
-        try:
-            setting, source = self._get_setting(setting_name)
-            return setting
-        except ValueError:
+        result = self._flattened_settings.get(setting_name)
+        if result is None:
             return fallback
+        setting, source = result
+        return setting
 
 
-def search_nested_dict(nested_dict: dict, dotted_key: str) -> Any:
-    keys = dotted_key.split(".")
-    current_dict = nested_dict
-    for k in keys:
-        if k not in current_dict:
-            raise ValueError(f"setting {dotted_key} not found in {json.dumps(nested_dict, indent=2)}")
-        current_dict = current_dict[k]
-    return current_dict
+def _flatten_into(flattened: dict[str, tuple[Any, str]], nested_dict: dict, source: str, prefix: str = ""):
+    for key, value in nested_dict.items():
+        dotted_key = f"{prefix}{key}"
+        flattened[dotted_key] = (value, source)
+        if isinstance(value, dict):
+            _flatten_into(flattened, value, source, f"{dotted_key}.")
 
 
 settings = SettingsManager()
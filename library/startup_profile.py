@@ -0,0 +1,73 @@
+"""
+Reports how long each module takes to import at startup, using python's -X importtime in a fresh interpreter (so
+nothing is already imported).
+
+    python jp_vocab_monitor_ui.py --profile-startup
+"""
+from typing import Optional
+import subprocess
+import sys
+
+from library.settings_manager import ROOT_FOLDER
+
+# should only be imported once they're used, see library.warm_up
+DEFERRED_MODULES = ["google.generativeai", "azure.cognitiveservices.speech", "fugashi", "sentencepiece", "httpx"]
+
+
+class ImportTime:
+    def __init__(self, module: str, self_us: int, cumulative_us: int, depth: int):
+        self.module = module
+        self.self_us = self_us
+        self.cumulative_us = cumulative_us
+        self.depth = depth
+
+
+def parse_importtime(output: str) -> list[ImportTime]:
+    """Parses lines like 'import time:       409 |     973367 |           google.generativeai.caching'."""
+    times = []
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue  # the header
+        name = fields[2].rstrip()
+        module = name.lstrip()
+        # nested imports are indented by two spaces per level, after the separator's own space
+        depth = (len(name) - len(module) - 1) // 2
+        times.append(ImportTime(module, int(fields[0]), int(fields[1]), depth))
+    return times
+
+
+def profile_startup(module: str = "jp_vocab_monitor_ui", top: int = 20) -> Optional[str]:
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=ROOT_FOLDER,
+                            capture_output=True, text=True)
+    times = parse_importtime(result.stderr)
+    if result.returncode != 0 or not times:
+        print(result.stderr)
+        return None
+
+    total_us = sum(t.self_us for t in times)
+    lines = [f"Importing {module} took {total_us / 1e6:.3f}s ({len(times)} modules)", ""]
+    lines.append(f"Slowest imports by cumulative time (ms), down to {top}:")
+    # the app's own imports and the ones directly below them, rather than every nested module
+    shallow = sorted((t for t in times if t.depth <= 1), key=lambda t: t.cumulative_us, reverse=True)
+    for t in shallow[:top]:
+        lines.append(f"{t.cumulative_us / 1000:>10.1f}  {'  ' * t.depth}{t.module}")
+    lines.append("")
+    lines.append("Slowest modules by their own time (ms):")
+    for t in sorted(times, key=lambda t: t.self_us, reverse=True)[:top]:
+        lines.append(f"{t.self_us / 1000:>10.1f}  {t.module}")
+    imported = {t.module for t in times}
+    eager = [m for m in DEFERRED_MODULES if m in imported]
+    lines.append("")
+    lines.append(f"Imported at startup, but should be deferred: {', '.join(eager)}" if eager
+                 else "All heavy dependencies are deferred.")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    report = profile_startup(sys.argv[1] if len(sys.argv) > 1 else "jp_vocab_monitor_ui")
+    if report is None:
+        sys.exit(1)
+    print(report)
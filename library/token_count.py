@@ -1,18 +1,68 @@
-import sentencepiece as spm
+from collections import OrderedDict
+from threading import Lock
+from typing import Optional, TYPE_CHECKING
+import os
 
+from library.settings_manager import ROOT_FOLDER
 
-sp = spm.SentencePieceProcessor(
-    model_file=r'library\tokenizer\tokenizer.model')
+if TYPE_CHECKING:
+    import sentencepiece as spm
 
+TOKENIZER_MODEL_PATH = os.path.join(ROOT_FOLDER, "library", "tokenizer", "tokenizer.model")
+# the same history lines are counted for every request, so recent counts are kept around
+TOKEN_COUNT_CACHE_SIZE = 4096
 
-def get_token_count(text: str) -> int:
-    tokenized = sp.encode(text, out_type=str)
-    return len(tokenized)
+_sp = None  # type: Optional["spm.SentencePieceProcessor"]
+_sp_lock = Lock()
+
+_token_counts = OrderedDict()  # type: OrderedDict[str, int]
+_token_counts_lock = Lock()
+
+
+def _get_processor() -> "spm.SentencePieceProcessor":
+    # loaded on first use, so importing this module (e.g. via ai_requests) doesn't pay for it at startup
+    global _sp
+    if _sp is None:
+        with _sp_lock:
+            if _sp is None:
+                import sentencepiece as spm
+                _sp = spm.SentencePieceProcessor(model_file=TOKENIZER_MODEL_PATH)
+    return _sp
+
+
+def get_token_count(text: str, cache: bool = True) -> int:
+    return get_token_counts([text], cache)[0]
+
+
+def get_token_counts(texts: list[str], cache: bool = True) -> list[int]:
+    """
+    Counts for several texts at once; only the ones that aren't cached are tokenized, in a single batch.
+    Pass cache=False for texts that won't be counted again (e.g. whole prompts), so they don't crowd out the history
+    lines and aren't kept alive by the cache.
+    """
+    if not cache:
+        return [len(ids) for ids in _get_processor().encode(texts)]
+    counts = {}  # type: dict[str, int]
+    with _token_counts_lock:
+        for text in texts:
+            if text in _token_counts:
+                _token_counts.move_to_end(text)
+                counts[text] = _token_counts[text]
+    missing = list({text: None for text in texts if text not in counts})
+    if missing:
+        encoded = _get_processor().encode(missing, out_type=str)
+        with _token_counts_lock:
+            for text, tokens in zip(missing, encoded):
+                counts[text] = len(tokens)
+                _token_counts[text] = len(tokens)
+            while len(_token_counts) > TOKEN_COUNT_CACHE_SIZE:
+                _token_counts.popitem(last=False)
+    return [counts[text] for text in texts]
 
 
 def get_tokens(text: str) -> list[str]:
-    return sp.encode(text, out_type=str)
+    return _get_processor().encode(text, out_type=str)
 
 
 def decode_tokens(tokens: list[str]) -> str:
-    return sp.Decode(tokens)
+    return _get_processor().Decode(tokens)
@@ -0,0 +1,87 @@
+"""
+The heavy dependencies (Gemini, Azure TTS, fugashi, the tokenizer) are imported on first use, so the window shows up
+quickly. start_warm_up then loads the ones that the current settings will use on a background thread, so that the
+first request doesn't pay for them either.
+"""
+from threading import Thread
+from typing import Callable
+import logging
+import time
+
+from library.ai_requests import AI_SERVICE_GEMINI
+from library.settings_manager import settings
+
+DEFINE_WITHOUT_AI = 'Define (without AI)'
+BUTTON_ACTION_SETTINGS = ['ui.translate_button_action', 'ui.analyze_button_action', 'ui.define_button_action']
+
+
+def _uses_gemini() -> bool:
+    return settings.get_setting_fallback('ai_settings.api', None) == AI_SERVICE_GEMINI
+
+
+def _uses_tts() -> bool:
+    return bool(settings.get_setting_fallback('azure_tts.speech_key', ""))
+
+
+def _uses_dictionary() -> bool:
+    return any(settings.get_setting_fallback(key, None) == DEFINE_WITHOUT_AI for key in BUTTON_ACTION_SETTINGS)
+
+
+def _uses_async_core() -> bool:
+    return settings.get_setting_fallback('ai_settings.streaming_core', "threads") == "async"
+
+
+def _load_gemini():
+    import google.generativeai
+
+
+def _load_tts():
+    import azure.cognitiveservices.speech
+
+
+def _load_dictionary():
+    from library.get_dictionary_defs import get_definitions_string
+    from library.dictionary_index import get_dictionary_index
+    get_dictionary_index()
+    get_definitions_string("")
+
+
+def _load_tokenizer():
+    from library.token_count import get_token_count
+    get_token_count("")
+
+
+def _load_async_core():
+    import library.ai_requests_async
+
+
+# name, whether the settings need it, how to load it
+WARM_UP_TASKS = [
+    ("tokenizer", lambda: True, _load_tokenizer),
+    ("gemini", _uses_gemini, _load_gemini),
+    ("async streaming core", _uses_async_core, _load_async_core),
+    ("dictionary", _uses_dictionary, _load_dictionary),
+    ("azure tts", _uses_tts, _load_tts),
+]  # type: list[tuple[str, Callable[[], bool], Callable[[], None]]]
+
+
+def warm_up():
+    for name, is_needed, load in WARM_UP_TASKS:
+        if not is_needed():
+            continue
+        start = time.perf_counter()
+        try:
+            load()
+        except Exception as e:
+            # it'll fail again (and be reported properly) when it's actually used
+            logging.warning(f"Failed to warm up {name}: {e}")
+            continue
+        logging.info(f"Warmed up {name} in {time.perf_counter() - start:.2f}s")
+
+
+def start_warm_up():
+    if not settings.get_setting_fallback('startup.warm_up', True):
+        return
+    thread = Thread(target=warm_up)
+    thread.daemon = True
+    thread.start()